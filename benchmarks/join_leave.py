@@ -0,0 +1,102 @@
+"""
+Microbenchmark for utils.join_leave.process_clan_events against the implementation it replaced.
+
+Generates join/leave histories of increasing length, checks both versions return the same events and prints the
+timings.
+
+    python -m benchmarks.join_leave [--runs 20]
+"""
+import argparse
+import copy
+import datetime
+import random
+import timeit
+
+from utils.join_leave import process_clan_events
+
+
+def legacy_process_clan_events(events):
+    events_copy = copy.deepcopy(events)
+    corrected_events = []
+
+    while events_copy:
+        event = events_copy.pop(0)
+
+        if event.get("type") == "leave":
+            corrected_events.append(event)
+            continue
+
+        if event.get("type") == "join":
+            corrected_events.append(event)
+            clan_tag = event.get("tag")
+            clan_id = event.get("clan")
+
+            leave_index = next(
+                (i for i, e in enumerate(events_copy)
+                 if e.get("type") == "leave" and e.get("tag") == clan_tag and e.get("clan") == clan_id),
+                None
+            )
+
+            if leave_index is not None:
+                leave_event = events_copy.pop(leave_index)
+                next_join = next(
+                    (e for e in events_copy if e.get("type") == "join"),
+                    None
+                )
+                next_join_time = next_join["time"] if next_join else leave_event["time"]
+                leave_event["time"] = next_join_time
+                corrected_events.append(leave_event)
+
+    corrected_events_sorted = sorted(
+        corrected_events,
+        key=lambda e: (
+            e["time"],
+            0 if e["type"] == "leave" else 1
+        )
+    )
+
+    final_events = []
+    active_clans = set()
+    for event in corrected_events_sorted:
+        clan_id = event.get("clan")
+        if event.get("type") == "join":
+            active_clans.add(clan_id)
+            final_events.append(event)
+        elif event.get("type") == "leave":
+            if clan_id in active_clans:
+                active_clans.remove(clan_id)
+            final_events.append(event)
+    return final_events
+
+
+def generate_history(length: int, clans: int = 8, seed: int = 0) -> list[dict]:
+    """A player hopping between a handful of clans, with the occasional missing or duplicated event"""
+    rng = random.Random(seed)
+    time = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    events = []
+    current = None
+    while len(events) < length:
+        time += datetime.timedelta(minutes=rng.randint(0, 600))
+        clan = f"#CLAN{rng.randrange(clans)}"
+        roll = rng.random()
+        if current is not None and roll < 0.9:
+            events.append({"type": "leave", "clan": current, "time": time, "tag": "#PLAYER", "clan_name": current})
+        if roll > 0.05:
+            events.append({"type": "join", "clan": clan, "time": time, "tag": "#PLAYER", "clan_name": clan})
+            current = clan
+    return events[:length]
+
+
+def main(runs: int):
+    for length in (50, 250, 1000, 5000):
+        events = generate_history(length=length, seed=length)
+        assert process_clan_events(events) == legacy_process_clan_events(events), f"outputs differ at {length} events"
+        legacy = min(timeit.repeat(lambda: legacy_process_clan_events(events), number=1, repeat=runs))
+        current = min(timeit.repeat(lambda: process_clan_events(events), number=1, repeat=runs))
+        print(f"{length:>6} events  legacy {legacy * 1000:9.3f}ms  linear {current * 1000:8.3f}ms  {legacy / current:7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark join/leave normalization")
+    parser.add_argument("--runs", type=int, default=20)
+    main(runs=parser.parse_args().runs)
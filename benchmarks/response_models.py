@@ -0,0 +1,68 @@
+"""
+Measures what the TrustedJSONResponse fast path saves over FastAPI's default response handling.
+
+The default path for a route with response_model is validate -> dump by alias -> json.dumps, for a plain dict it is
+jsonable_encoder -> json.dumps. The fast path is a single orjson.dumps, plus conform_rows for join-leave. Payloads are shaped like the join-leave,
+legends clan and previous wars responses.
+
+    python -m benchmarks.response_models [--runs 20]
+"""
+import argparse
+import datetime
+import json
+import random
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from models.clan import JoinLeaveEntry, JoinLeaveList
+from utils.fast_response import conform_rows
+from utils.streaming import dumps
+
+
+def join_leave_payload(count: int = 250) -> dict:
+    now = datetime.datetime(2024, 5, 1)
+    return {"items": [{"name": f"player {i}", "tag": f"#P{i}", "th": random.randint(1, 16), "time": now - datetime.timedelta(minutes=i),
+                       "clan": "#CLAN", "type": random.choice(["join", "leave"])} for i in range(count)]}
+
+
+def legends_payload(members: int = 50) -> dict:
+    attack = {"change": 32, "time": 1714550400, "trophies": 5200}
+    day = {"new_attacks": [attack] * 8, "new_defenses": [attack] * 8, "num_attacks": 8}
+    return {"tag": "#CLAN", "name": "clan", "memberList": [{"name": f"player {i}", "tag": f"#P{i}", "league": "Legend League",
+                                                            "townhall": 16, "legends": day} for i in range(members)]}
+
+
+def wars_payload(wars: int = 50) -> dict:
+    member = {"tag": "#P", "name": "player", "townhallLevel": 16, "mapPosition": 1, "opponentAttacks": 1,
+              "attacks": [{"attackerTag": "#P", "defenderTag": "#D", "stars": 3, "destructionPercentage": 100, "order": 1, "duration": 120}] * 2}
+    side = {"tag": "#CLAN", "name": "clan", "stars": 150, "destructionPercentage": 100.0, "members": [member] * 50}
+    return {"items": [{"state": "warEnded", "teamSize": 50, "preparationStartTime": "20240501T000000.000Z",
+                       "endTime": "20240502T230000.000Z", "clan": side, "opponent": side} for _ in range(wars)]}
+
+
+def validated(payload: dict) -> bytes:
+    model = JoinLeaveList.model_validate(payload)
+    return json.dumps(model.model_dump(mode="json", by_alias=True)).encode()
+
+
+def encoded(payload: dict) -> bytes:
+    return json.dumps(jsonable_encoder(payload)).encode()
+
+
+def conformed(payload: dict) -> bytes:
+    return dumps({"items": conform_rows(JoinLeaveEntry, payload["items"])})
+
+
+def main(runs: int):
+    cases = [("join-leave", join_leave_payload(), validated, conformed), ("legends clan", legends_payload(), encoded, dumps),
+             ("previous wars", wars_payload(), encoded, dumps)]
+    for name, payload, default, fast in cases:
+        before = min(timeit.repeat(lambda: default(payload), number=1, repeat=runs))
+        after = min(timeit.repeat(lambda: fast(payload), number=1, repeat=runs))
+        print(f"{name:>14}  default {before * 1000:9.3f}ms  orjson {after * 1000:8.3f}ms  {before / after:6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the trusted response fast path")
+    parser.add_argument("--runs", type=int, default=20)
+    main(runs=parser.parse_args().runs)
@@ -11,12 +11,16 @@ from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 
 from slowapi import Limiter
 from slowapi.util import get_ipaddr
 
 from utils.utils import config
+from utils.streaming import EventStreamGZipMiddleware
+from utils.server_clans import server_clans
+from utils.player_names import player_names
+from utils.player_autocomplete import player_autocomplete
+from utils.war_feed import war_feed
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,13 +34,20 @@ middleware = [
         allow_headers=["*"],
     ),
     Middleware(
-        GZipMiddleware,
+        EventStreamGZipMiddleware,
         minimum_size=500
     )
 ]
 
 app = FastAPI(middleware=middleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.add_event_handler("startup", server_clans.start)
+app.add_event_handler("shutdown", server_clans.stop)
+app.add_event_handler("startup", player_names.start)
+app.add_event_handler("shutdown", player_names.stop)
+app.add_event_handler("startup", player_autocomplete.start)
+app.add_event_handler("shutdown", player_autocomplete.stop)
+app.add_event_handler("shutdown", war_feed.stop)
 
 
 
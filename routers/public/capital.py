@@ -1,13 +1,14 @@
 
 import coc
 
-from collections import defaultdict
-from fastapi import  Request, Response, HTTPException
+from fastapi import  Request, Response, HTTPException, Depends
 from fastapi import APIRouter
 from typing import List
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_ipaddr
 from utils.utils import fix_tag, db_client, leagues
+from utils.streaming import JSONStreamResponse, wants_ndjson
+from utils.fieldsets import Fields, fields_param
 from datetime import datetime
 
 
@@ -129,21 +130,21 @@ async def capital_stats_leagues(weekend: str, request: Request, response: Respon
 @router.get("/capital/{clan_tag}",
          tags=["Clan Capital Endpoints"],
          name="Log of Raid Weekends")
-async def capital_log(clan_tag: str, request: Request, response: Response, limit: int = 5):
-    results = await db_client.capital.find({"clan_tag" : fix_tag(clan_tag)}).limit(limit).sort("data.startTime", -1).to_list(length=None)
+async def capital_log(clan_tag: str, request: Request, response: Response, limit: int = 5, fields: Fields = Depends(fields_param)):
+    #fields name raid weekend keys like capital_bulk does, the stored weekend sits under data
+    results = await db_client.capital.find({"clan_tag" : fix_tag(clan_tag)}, fields.projection(prefix="data.", always=["clan_tag"])).limit(limit).sort("data.startTime", -1).to_list(length=None)
     for result in results:
-        del result["_id"]
+        result.pop("_id", None)
     return results
 
 @router.post("/capital/bulk",
          tags=["Clan Capital Endpoints"],
          name="Fetch Raid Weekends in Bulk (max 100 tags)")
-async def capital_bulk(clan_tags: List[str], request: Request, response: Response):
-    results = await db_client.capital.find({"clan_tag": {"$in" : [fix_tag(tag) for tag in clan_tags[:100]]}}).to_list(length=None)
-    fixed_results = defaultdict(list)
-    for result in results:
-        del result["_id"]
-        tag = result.get("clan_tag")
-        del result["clan_tag"]
-        fixed_results[tag].append(result.get("data"))
-    return dict(fixed_results)
\ No newline at end of file
+async def capital_bulk(clan_tags: List[str], request: Request, response: Response, fields: Fields = Depends(fields_param)):
+    projection = fields.projection(prefix="data.", always=["clan_tag"]) or {"_id" : 0, "clan_tag" : 1, "data" : 1}
+    cursor = db_client.capital.find({"clan_tag": {"$in" : [fix_tag(tag) for tag in clan_tags[:100]]}},
+                                    projection).sort({"clan_tag" : 1, "data.startTime" : -1})
+    #ndjson keeps the clan_tag on every line, the default json body is grouped by clan like before
+    if wants_ndjson(request):
+        return JSONStreamResponse(cursor, request=request)
+    return JSONStreamResponse(cursor, group_by="clan_tag", transform=lambda doc: doc.get("data"))
\ No newline at end of file
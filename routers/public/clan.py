@@ -1,29 +1,50 @@
 import coc
 import pendulum as pend
 
-from bson.objectid import ObjectId
-from fastapi import  Request, Response, HTTPException
+from fastapi import  Request, Response, HTTPException, Depends, Query
 from fastapi import APIRouter
-from models.clan import JoinLeaveList
+from typing import List
+from models.clan import JoinLeaveEntry, JoinLeaveList
 from slowapi import Limiter
 from slowapi.util import get_ipaddr
 from utils.utils import fix_tag, leagues, db_client
+from utils.streaming import JSONStreamResponse
+from utils.fast_response import TrustedJSONResponse, conform_rows, model_projection
+from utils.fieldsets import Fields, fields_param
+from utils.clan_search import ClanSortField, decode_keyset, encode_keyset, keyset_query
+from utils.clan_activity import BUCKET_SIZE, Granularity, get_series
 
 
 router = APIRouter(tags=["Clan Endpoints"])
 
+MAX_ACTIVITY_BUCKETS = 2400
+
 
 
 @router.get("/clan/{clan_tag}/basic",
          name="Basic Clan Object")
-async def clan_basic(clan_tag: str, request: Request, response: Response):
+async def clan_basic(clan_tag: str, request: Request, response: Response, fields: Fields = Depends(fields_param)):
     clan_tag = fix_tag(clan_tag)
-    result = await db_client.basic_clan.find_one({"tag": clan_tag})
+    result = await db_client.basic_clan.find_one({"tag": clan_tag}, fields.projection())
     if result is not None:
-        del result["_id"]
+        result.pop("_id", None)
     return result
 
 
+@router.post("/clan/bulk",
+         name="Basic Clan Objects in Bulk, keyed by tag (max 500 tags)")
+async def clan_bulk(clan_tags: List[str], request: Request, response: Response, memberList: bool = True, fields: Fields = Depends(fields_param)):
+    clan_tags = list(dict.fromkeys(fix_tag(tag) for tag in clan_tags[:500]))
+    if fields:
+        projection = fields.projection(always=["tag"])
+        if not memberList:
+            projection = {k: v for k, v in projection.items() if k != "memberList" and not k.startswith("memberList.")}
+    else:
+        projection = {"_id" : 0} if memberList else {"_id" : 0, "memberList" : 0}
+    results = await db_client.basic_clan.find({"tag" : {"$in" : clan_tags}}, projection).to_list(length=None)
+    return {result.get("tag") : result for result in results}
+
+
 
 
 @router.get(
@@ -38,8 +59,9 @@ async def clan_join_leave(clan_tag: str, request: Request, response: Response, t
             {"time" : {"$gte" : pend.from_timestamp(timestamp=timestamp_start, tz=pend.UTC)}},
             {"time": {"$lte": pend.from_timestamp(timestamp=time_stamp_end, tz=pend.UTC)}}
         ]
-    }, {"_id" : 0}).sort({"time" : -1}).limit(limit=limit).to_list(length=None)
-    return {"items" : result}
+    }, model_projection(JoinLeaveEntry)).sort({"time" : -1}).limit(limit=limit).to_list(length=None)
+    #response_model only documents the shape, conform_rows keeps the rows to it without validating each one
+    return TrustedJSONResponse({"items" : conform_rows(JoinLeaveEntry, result)})
 
 
 
@@ -49,7 +71,9 @@ async def clan_join_leave(clan_tag: str, request: Request, response: Response, t
 async def clan_filter(request: Request, response: Response,  limit: int= 100, location_id: int = None, minMembers: int = None, maxMembers: int = None,
                       minLevel: int = None, maxLevel: int = None, openType: str = None,
                       minWarWinStreak: int = None, minWarWins: int = None, minClanTrophies: int = None, maxClanTrophies: int = None, capitalLeague: str= None,
-                      warLeague: str= None, memberList: bool = True, before:str =None, after: str=None):
+                      warLeague: str= None, memberList: bool = True, before:str =None, after: str=None,
+                      sort_by: ClanSortField = Query(default=None, description="Field to sort and page by, clans that don't have the field are left out"),
+                      descending: bool = None):
     queries = {}
     queries['$and'] = []
     if location_id:
@@ -86,30 +110,55 @@ async def clan_filter(request: Request, response: Response,  limit: int= 100, lo
         queries['$and'].append({"clanPoints": {"$gte": minClanTrophies}})
 
     if maxClanTrophies:
-        queries['$and'].append({"clanPoints": {"$gte": maxClanTrophies}})
+        queries['$and'].append({"clanPoints": {"$lte": maxClanTrophies}})
 
-    if after:
-        queries['$and'].append({"_id": {"$gt": ObjectId(after)}})
+    #paging by _id keeps its old ascending order, any other field defaults to highest first
+    if descending is None:
+        descending = sort_by is not None
+    forward, backward = ("$lt", "$gt") if descending else ("$gt", "$lt")
+    #a missing value would sort before every number and can't be continued from with $gt/$lt, so those clans are left out
+    if sort_by is not None:
+        queries['$and'].append({sort_by.value: {"$ne": None}})
 
+    #after & before together page through the clans between the two cursors
+    if after:
+        value, _id = decode_keyset(after, sort_by=sort_by)
+        queries['$and'].append(keyset_query(sort_by=sort_by, value=value, _id=_id, op=forward))
     if before:
-        queries['$and'].append({"_id": {"$lt": ObjectId(before)}})
+        value, _id = decode_keyset(before, sort_by=sort_by)
+        queries['$and'].append(keyset_query(sort_by=sort_by, value=value, _id=_id, op=backward))
 
 
     if queries["$and"] == []:
         queries = {}
 
     limit = min(limit, 1000)
-    results = await db_client.basic_clan.find(queries).limit(limit).sort("_id", 1).to_list(length=limit)
-    return_data = {"items" : [], "before": "", "after" : ""}
-    if results:
-        return_data["before"] = str(results[0].get("_id"))
-        return_data["after"] = str(results[-1].get("_id"))
-        for data in results:
-            del data["_id"]
-            if not memberList:
-                del data["memberList"]
-        return_data["items"] = results
-    return return_data
+    direction = -1 if descending else 1
+    sort = [("_id", direction)] if sort_by is None else [(sort_by.value, direction), ("_id", direction)]
+    projection = None if memberList else {"memberList" : 0}
+    if before and not after:
+        #walk backwards from the cursor, then flip the page back into the requested order
+        results = await db_client.basic_clan.find(queries, projection).sort([(field, -d) for field, d in sort]).limit(limit).to_list(length=limit)
+        results.reverse()
+
+        async def previous_page():
+            for result in results:
+                yield result
+        cursor = previous_page()
+    else:
+        cursor = db_client.basic_clan.find(queries, projection).sort(sort).limit(limit)
+    page = {"before": "", "after" : ""}
+
+    def strip(data: dict):
+        _id = data.pop("_id")
+        key = str(_id) if sort_by is None else encode_keyset(data.get(sort_by.value), _id)
+        if not page["before"]:
+            page["before"] = key
+        page["after"] = key
+        return data
+
+    #before/after are only known once the last clan is written, so they follow the items (the last line for ndjson)
+    return JSONStreamResponse(cursor, request=request, wrap="items", transform=strip, trailer=lambda: page)
 
 
 
@@ -128,3 +177,17 @@ async def clan_historical(clan_tag: str, request: Request, response: Response, t
         }, {"_id": 0}).sort({"time": -1}).limit(limit=limit).to_list(length=25000)
 
     return {"items" : historical_data}
+
+
+
+@router.get("/clan/{clan_tag}/activity",
+         name="Hourly or daily count of player events in a clan, defaults to the last 90 days")
+async def clan_activity_series(clan_tag: str, request: Request, response: Response, granularity: Granularity = Granularity.day,
+                               timestamp_start: int = None, timestamp_end: int = None):
+    clan_tag = fix_tag(clan_tag)
+    timestamp_end = timestamp_end or int(pend.now(tz=pend.UTC).timestamp())
+    timestamp_start = timestamp_start if timestamp_start is not None else timestamp_end - 90 * 86400
+    if (timestamp_end - timestamp_start) / BUCKET_SIZE[granularity] > MAX_ACTIVITY_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Max {MAX_ACTIVITY_BUCKETS} {granularity.value} buckets can be pulled at one time")
+    items = await get_series(clan_tag=clan_tag, granularity=granularity, start=timestamp_start, end=timestamp_end)
+    return {"granularity" : granularity.value, "items" : [{"time" : i.get("bucket"), "total" : i.get("total", 0), "counts" : i.get("counts", {})} for i in items]}
@@ -0,0 +1,296 @@
+import coc
+import orjson
+import pendulum as pend
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import datetime
+from enum import Enum
+from fastapi import Request, Response, HTTPException, APIRouter, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Annotated
+from utils.utils import fix_tag, db_client
+
+
+router = APIRouter(tags=["Dataset Endpoints"])
+
+BATCH_ROWS = 10_000
+# exports that aren't scoped to clans can cover at most this many seconds
+MAX_UNSCOPED_WINDOW = 7 * 86400
+
+
+class DatasetFormat(str, Enum):
+    arrow = "arrow"
+    parquet = "parquet"
+
+
+class StreamSink:
+    """Write-only file object that hands back whatever was written since the last drain, so encoded batches can be streamed"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def json_or_none(value):
+    return None if value is None else orjson.dumps(value).decode()
+
+
+def coc_time(value: str):
+    return None if value is None else coc.Timestamp(data=value).time.replace(tzinfo=pend.UTC)
+
+
+def player_history_rows(doc: dict):
+    yield {
+        "tag": doc.get("tag"),
+        "name": doc.get("name"),
+        "clan": doc.get("clan"),
+        "type": doc.get("type"),
+        "time": datetime.utcfromtimestamp(doc["time"]) if doc.get("time") is not None else None,
+        "th": doc.get("th"),
+        "p_value": json_or_none(doc.get("p_value")),
+        "value": json_or_none(doc.get("value")),
+    }
+
+
+def join_leave_rows(doc: dict):
+    yield {
+        "tag": doc.get("tag"),
+        "name": doc.get("name"),
+        "clan": doc.get("clan"),
+        "type": doc.get("type"),
+        "time": doc.get("time"),
+        "th": doc.get("th"),
+    }
+
+
+def war_attack_rows(doc: dict):
+    war = doc.get("data", {})
+    preparation_start = coc_time(war.get("preparationStartTime"))
+    end_time = coc_time(war.get("endTime"))
+    sides = (war.get("clan", {}), war.get("opponent", {}))
+    for attacking, defending in (sides, sides[::-1]):
+        defenders = {m.get("tag"): m for m in defending.get("members", [])}
+        for member in attacking.get("members", []):
+            for attack in member.get("attacks", []):
+                defender = defenders.get(attack.get("defenderTag"), {})
+                yield {
+                    "war_tag": war.get("tag"),
+                    "preparation_start_time": preparation_start,
+                    "end_time": end_time,
+                    "team_size": war.get("teamSize"),
+                    "attacks_per_member": war.get("attacksPerMember"),
+                    "attacker_clan": attacking.get("tag"),
+                    "defender_clan": defending.get("tag"),
+                    "attacker_tag": attack.get("attackerTag"),
+                    "attacker_townhall": member.get("townhallLevel"),
+                    "attacker_map_position": member.get("mapPosition"),
+                    "defender_tag": attack.get("defenderTag"),
+                    "defender_townhall": defender.get("townhallLevel"),
+                    "defender_map_position": defender.get("mapPosition"),
+                    "stars": attack.get("stars"),
+                    "destruction": attack.get("destructionPercentage"),
+                    "order": attack.get("order"),
+                    "duration": attack.get("duration"),
+                }
+
+
+def capital_rows(doc: dict):
+    raid = doc.get("data", {})
+    start_time = coc_time(raid.get("startTime"))
+    end_time = coc_time(raid.get("endTime"))
+    for member in raid.get("members", []):
+        yield {
+            "clan_tag": doc.get("clan_tag"),
+            "start_time": start_time,
+            "end_time": end_time,
+            "state": raid.get("state"),
+            "tag": member.get("tag"),
+            "name": member.get("name"),
+            "attacks": member.get("attacks"),
+            "attack_limit": member.get("attackLimit"),
+            "bonus_attack_limit": member.get("bonusAttackLimit"),
+            "capital_resources_looted": member.get("capitalResourcesLooted"),
+        }
+
+
+def war_dedup_key(doc: dict):
+    """(window, id) of a war, every copy of a war shares its preparationStartTime so dedup only has to remember one window"""
+    war = doc.get("data", {})
+    unique_id = "-".join(sorted([war.get("clan", {}).get("tag", ""), war.get("opponent", {}).get("tag", "")]))
+    return war.get("preparationStartTime"), unique_id
+
+
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+
+DATASETS = {
+    "player_history": {
+        "collection": "player_history",
+        "clan_field": "clan",
+        "time_field": "time",
+        "time_format": "unix",
+        "rows": player_history_rows,
+        "schema": pa.schema([("tag", pa.string()), ("name", pa.string()), ("clan", pa.string()), ("type", pa.string()),
+                             ("time", TIMESTAMP), ("th", pa.int32()), ("p_value", pa.string()), ("value", pa.string())]),
+    },
+    "join_leave_history": {
+        "collection": "join_leave_history",
+        "clan_field": "clan",
+        "time_field": "time",
+        "time_format": "datetime",
+        "rows": join_leave_rows,
+        "schema": pa.schema([("tag", pa.string()), ("name", pa.string()), ("clan", pa.string()), ("type", pa.string()),
+                             ("time", TIMESTAMP), ("th", pa.int32())]),
+    },
+    "war_attacks": {
+        "collection": "clan_wars",
+        "clan_field": ["data.clan.tag", "data.opponent.tag"],
+        "time_field": "data.preparationStartTime",
+        "time_format": "coc",
+        "rows": war_attack_rows,
+        "dedup": war_dedup_key,
+        "sort": [("data.preparationStartTime", 1)],
+        "projection": {"_id": 0, "data.tag": 1, "data.preparationStartTime": 1, "data.endTime": 1, "data.teamSize": 1,
+                       "data.attacksPerMember": 1, "data.clan.tag": 1, "data.opponent.tag": 1,
+                       "data.clan.members.tag": 1, "data.clan.members.townhallLevel": 1, "data.clan.members.mapPosition": 1,
+                       "data.clan.members.attacks": 1, "data.opponent.members.tag": 1, "data.opponent.members.townhallLevel": 1,
+                       "data.opponent.members.mapPosition": 1, "data.opponent.members.attacks": 1},
+        "schema": pa.schema([("war_tag", pa.string()), ("preparation_start_time", TIMESTAMP), ("end_time", TIMESTAMP),
+                             ("team_size", pa.int32()), ("attacks_per_member", pa.int32()), ("attacker_clan", pa.string()),
+                             ("defender_clan", pa.string()), ("attacker_tag", pa.string()), ("attacker_townhall", pa.int32()),
+                             ("attacker_map_position", pa.int32()), ("defender_tag", pa.string()), ("defender_townhall", pa.int32()),
+                             ("defender_map_position", pa.int32()), ("stars", pa.int32()), ("destruction", pa.float64()),
+                             ("order", pa.int32()), ("duration", pa.int32())]),
+    },
+    "capital": {
+        "collection": "capital",
+        "clan_field": "clan_tag",
+        "time_field": "data.startTime",
+        "time_format": "coc",
+        "rows": capital_rows,
+        "projection": {"_id": 0, "clan_tag": 1, "data.startTime": 1, "data.endTime": 1, "data.state": 1, "data.members": 1},
+        "schema": pa.schema([("clan_tag", pa.string()), ("start_time", TIMESTAMP), ("end_time", TIMESTAMP), ("state", pa.string()),
+                             ("tag", pa.string()), ("name", pa.string()), ("attacks", pa.int32()), ("attack_limit", pa.int32()),
+                             ("bonus_attack_limit", pa.int32()), ("capital_resources_looted", pa.int64())]),
+    },
+}
+
+
+def time_bound(timestamp: int, time_format: str):
+    if time_format == "unix":
+        return timestamp
+    moment = pend.from_timestamp(timestamp, tz=pend.UTC)
+    if time_format == "coc":
+        return moment.strftime('%Y%m%dT%H%M%S.000Z')
+    return moment
+
+
+def build_query(dataset: dict, timestamp_start: int, timestamp_end: int, clans: list | None):
+    time_field, time_format = dataset["time_field"], dataset["time_format"]
+    query = [
+        {time_field: {"$gte": time_bound(timestamp_start, time_format)}},
+        {time_field: {"$lte": time_bound(timestamp_end, time_format)}}
+    ]
+    if clans:
+        clan_fields = dataset["clan_field"] if isinstance(dataset["clan_field"], list) else [dataset["clan_field"]]
+        query.append({"$or": [{field: {"$in": clans}} for field in clan_fields]})
+    return {"$and": query}
+
+
+async def encode_dataset(dataset: dict, cursor, format: DatasetFormat):
+    schema = dataset["schema"]
+    sink = StreamSink()
+    native_sink = pa.PythonFile(sink, mode="w")
+    if format == DatasetFormat.parquet:
+        writer = pq.ParquetWriter(native_sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(native_sink, schema)
+
+    dedup = dataset.get("dedup")
+    seen, window = set(), None
+    columns = {name: [] for name in schema.names}
+    num_rows = 0
+
+    def write_batch():
+        writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+        for column in columns.values():
+            column.clear()
+
+    try:
+        async for doc in cursor:
+            if dedup is not None:
+                # the cursor is sorted on the window, so ids from earlier windows can't come up again
+                doc_window, unique_id = dedup(doc)
+                if doc_window != window:
+                    seen.clear()
+                    window = doc_window
+                if unique_id in seen:
+                    continue
+                seen.add(unique_id)
+            for row in dataset["rows"](doc):
+                for name, column in columns.items():
+                    column.append(row.get(name))
+                num_rows += 1
+            if num_rows >= BATCH_ROWS:
+                write_batch()
+                num_rows = 0
+                yield sink.drain()
+        if num_rows:
+            write_batch()
+        writer.close()
+        yield sink.drain()
+    finally:
+        await cursor.close()
+
+
+@router.get("/dataset/{name}",
+         name="Bulk dataset as an Arrow IPC stream or Parquet file (name: player_history, join_leave_history, war_attacks, capital), "
+              "without clans the time window is limited to 7 days")
+async def dataset_export(name: str, request: Request, response: Response,
+                         timestamp_start: int = 0,
+                         timestamp_end: int = 9999999999,
+                         clans: Annotated[List[str], Query(max_length=100)] = None,
+                         format: DatasetFormat = DatasetFormat.arrow):
+    dataset = DATASETS.get(name)
+    if dataset is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset, use one of {', '.join(DATASETS)}")
+    clans = [fix_tag(clan) for clan in clans] if clans else None
+    if not clans and timestamp_end - timestamp_start > MAX_UNSCOPED_WINDOW:
+        raise HTTPException(status_code=400, detail=f"Pass clans or limit the export to {MAX_UNSCOPED_WINDOW // 86400} days")
+
+    collection = getattr(db_client, dataset["collection"])
+    projection = dataset.get("projection", {"_id": 0})
+    cursor = collection.find(build_query(dataset, timestamp_start, timestamp_end, clans), projection, allow_disk_use=True).batch_size(2000)
+    if "sort" in dataset:
+        cursor = cursor.sort(dataset["sort"])
+
+    if format == DatasetFormat.parquet:
+        media_type, extension = "application/vnd.apache.parquet", "parquet"
+    else:
+        media_type, extension = "application/vnd.apache.arrow.stream", "arrows"
+    return StreamingResponse(encode_dataset(dataset, cursor, format), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{name}-{timestamp_start}-{timestamp_end}.{extension}"'})
@@ -10,30 +10,13 @@ import requests
 from fastapi import  Request, Response, HTTPException, Header
 from fastapi import APIRouter
 from typing import List
-from utils.utils import fix_tag, redis, db_client, config, create_keys
+from utils.utils import fix_tag, redis, db_client, config, create_keys, get_proxy_session, close_proxy_session
 
 
 router = APIRouter(tags=["Internal Endpoints"])
 
-_proxy_session = None
-_proxy_session_loop = None
-
-
-async def get_proxy_session():
-    global _proxy_session, _proxy_session_loop
-
-    loop = asyncio.get_running_loop()
-    if _proxy_session is None or _proxy_session.closed or _proxy_session_loop is not loop:
-        timeout = aiohttp.ClientTimeout(total=30)
-        connector = aiohttp.TCPConnector(limit=50, ttl_dns_cache=300)
-        _proxy_session = aiohttp.ClientSession(timeout=timeout, connector=connector)
-        _proxy_session_loop = loop
-    return _proxy_session
-
-
 async def shutdown():
-    if _proxy_session is not None and not _proxy_session.closed:
-        await _proxy_session.close()
+    await close_proxy_session()
 
 
 async def fetch_image(url: str) -> bytes:
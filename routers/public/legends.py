@@ -2,6 +2,8 @@ from fastapi import Request, Response, HTTPException, APIRouter, Query
 from slowapi import Limiter
 from slowapi.util import get_ipaddr
 from utils.utils import db_client, fix_tag
+from utils import legend_seasons
+from utils.fast_response import TrustedJSONResponse
 
 
 
@@ -12,13 +14,12 @@ router = APIRouter(tags=["Legends"])
 async def legends_clan(clan_tag: str, date: str, request: Request, response: Response):
     basic_clan = await db_client.basic_clan.find_one({"tag" : fix_tag(clan_tag)}, {"_id" : 0, "tag" : 1, "name" : 1, "members" : 1, "memberList" : 1, "level" : 1, "location" : 1})
     members = basic_clan.get("memberList")
-    legend_stats = await db_client.player_stats_db.find({"tag": {"$in" : [m.get("tag") for m in members]}}, projection={"name": 1, "townhall": 1, "legends": 1, "tag": 1, "_id" : 0}).to_list(length=None)
+    legend_days = await legend_seasons.get_day(tags=[m.get("tag") for m in members if m.get("league") == "Legend League"], day=date)
 
-    legend_stats_map = {l.get("tag") : l for l in legend_stats}
     new_member_list = []
     for member in members:
         if member.get("league") == "Legend League":
-            legend_data = legend_stats_map.get(member.get("tag"), {}).get("legends", {}).get(date, {})
+            legend_data = legend_days.get(member.get("tag"), {})
             legend_data.pop("attacks", None)
             legend_data.pop("defenses", None)
             new_member_list.append({
@@ -30,7 +31,7 @@ async def legends_clan(clan_tag: str, date: str, request: Request, response: Res
             })
 
     basic_clan["memberList"] = new_member_list
-    return basic_clan
+    return TrustedJSONResponse(basic_clan)
 
 
 @router.get(path="/legends/streaks",
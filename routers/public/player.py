@@ -1,18 +1,22 @@
-import aiohttp
+import asyncio
 import coc
 import datetime
 import pendulum as pend
 import re
 import time
-import copy
 
-from collections import defaultdict
 from datetime import timedelta
-from fastapi import Request, Response, HTTPException, Query, APIRouter
+from fastapi import Request, Response, HTTPException, Query, APIRouter, Depends
 from slowapi import Limiter
 from slowapi.util import get_ipaddr
 from typing import List, Annotated
-from utils.utils import fix_tag, redis, db_client, gen_legend_date, gen_games_season, leagues
+from utils.utils import fix_tag, redis, db_client, gen_legend_date, gen_games_season, leagues, fetch_proxy_json
+from utils import cwl_cache, legend_seasons, player_history, war_index
+from utils.streaming import JSONStreamResponse
+from utils.join_leave import process_clan_events
+from utils.fieldsets import Fields, fields_param
+from utils.player_names import player_names
+from utils.player_autocomplete import player_autocomplete
 
 
 
@@ -20,13 +24,37 @@ router = APIRouter(tags=["Player Endpoints"])
 
 @router.get("/player/{player_tag}/stats",
          name="All collected Stats for a player (clan games, looted, activity, etc)")
-async def player_stat(player_tag: str, request: Request, response: Response):
+async def player_stat(player_tag: str, request: Request, response: Response, fields: Fields = Depends(fields_param)):
     player_tag = player_tag and "#" + re.sub(r"[^A-Z0-9]+", "", player_tag.upper()).replace("O", "0")
-    result = await db_client.player_stats_db.find_one({"tag": player_tag})
-    lb_spot = await db_client.player_leaderboard_db.find_one({"tag": player_tag})
+    result = await db_client.player_stats_db.find_one({"tag": player_tag}, fields.projection(always=["tag"], sources=STAT_SOURCES) or STAT_PROJECTION)
+    lb_spot = None
+    if not fields or fields.top_level() & LEADERBOARD_KEYS:
+        lb_spot = await db_client.player_leaderboard_db.find_one({"tag": player_tag}, LEADERBOARD_PROJECTION)
 
     if result is None:
         raise HTTPException(status_code=404, detail=f"No player found")
+    return fields.filter(player_stat_shape(result=result, lb_spot=lb_spot))
+
+
+STAT_PROJECTION = {"_id" : 0, "name" : 1, "tag" : 1, "townhall" : 1, "legends" : 1, "last_online" : 1, "gold" : 1, "elixir" : 1,
+                   "dark_elixir" : 1, "trophies" : 1, "warStars" : 1, "aggressive_capitalism" : 1, "donations" : 1, "capital_gold" : 1,
+                   "clan_games" : 1, "season_pass" : 1, "attack_wins" : 1, "activity" : 1, "clan_tag" : 1, "league" : 1}
+
+#response keys that are built from differently named stored fields
+STAT_SOURCES = {"looted" : ["gold", "elixir", "dark_elixir"], "clanCapitalContributions" : ["aggressive_capitalism"],
+                "capital" : ["capital_gold"], "location" : []}
+
+LEADERBOARD_KEYS = {"legends", "location"}
+LEADERBOARD_PROJECTION = {"_id" : 0, "tag" : 1, "global_rank" : 1, "local_rank" : 1, "country_name" : 1}
+
+#keeps the legends keys that aren't a yyyy-mm-dd day, so the years of daily history stay in mongo
+LEGENDS_WITHOUT_DAYS = {"$arrayToObject" : {"$filter" : {
+    "input" : {"$ifNull" : [{"$objectToArray" : "$legends"}, []]},
+    "cond" : {"$not" : [{"$regexMatch" : {"input" : "$$this.k", "regex" : r"^\d{4}-\d{2}-\d{2}$"}}]}
+}}}
+
+
+def player_stat_shape(result: dict, lb_spot: dict | None):
     try:
         del result["legends"]["streak"]
     except:
@@ -65,12 +93,38 @@ async def player_stat(player_tag: str, request: Request, response: Response):
     return result
 
 
+@router.post("/player/bulk",
+         name="All collected Stats for many players at once (max 500 tags)")
+async def player_stat_bulk(player_tags: List[str], request: Request, response: Response,
+                           legend_days: bool = Query(default=False, description='Set true to include the per day legends history of every player'),
+                           fields: Fields = Depends(fields_param)):
+    player_tags = list(dict.fromkeys(fix_tag(tag) for tag in player_tags[:500]))
+    projection = fields.projection(always=["tag"], sources=STAT_SOURCES) or STAT_PROJECTION
+    if not legend_days and "legends" in projection:
+        projection = projection | {"legends" : LEGENDS_WITHOUT_DAYS}
+
+    async def leaderboard():
+        if fields and not fields.top_level() & LEADERBOARD_KEYS:
+            return []
+        return await db_client.player_leaderboard_db.find({"tag" : {"$in" : player_tags}}, LEADERBOARD_PROJECTION).to_list(length=None)
+
+    results, lb_spots = await asyncio.gather(
+        db_client.player_stats_db.find({"tag" : {"$in" : player_tags}}, projection).to_list(length=None),
+        leaderboard()
+    )
+    results = {r.get("tag") : r for r in results}
+    lb_spots = {lb.get("tag") : lb for lb in lb_spots}
+    return {"items" : [fields.filter(player_stat_shape(result=results[tag], lb_spot=lb_spots.get(tag))) for tag in player_tags if tag in results]}
+
+
 @router.get("/player/{player_tag}/legends",
          name="Legend stats for a player")
 async def player_legend(player_tag: str, request: Request, response: Response, season: str = None):
     player_tag = fix_tag(player_tag)
     c_time = time.time()
-    result = await db_client.player_stats_db.find_one({"tag": player_tag}, projection={"name" : 1, "townhall" : 1, "legends" : 1, "tag" : 1})
+    #a season only needs its own bucket, the full legends map is only loaded when every day is asked for
+    projection = {"name" : 1, "townhall" : 1, "legends" : 1, "tag" : 1} if season is None else {"name" : 1, "townhall" : 1, "tag" : 1}
+    result = await db_client.player_stats_db.find_one({"tag": player_tag}, projection=projection)
     if result is None:
         raise HTTPException(status_code=404, detail=f"No player found")
     ranking_data = await db_client.player_leaderboard_db.find_one({"tag": player_tag}, projection={"_id" : 0})
@@ -87,19 +141,11 @@ async def player_legend(player_tag: str, request: Request, response: Response, s
             ranking_data["global_rank"] = self_global_ranking.get("rank")
 
     legend_data = result.get('legends', {})
-    if season and legend_data != {}:
-        year, month = map(int, season.split("-"))
-        previous_month = pend.date(year, month, 1).subtract(months=1)
-        prev_year, prev_month = previous_month.year, previous_month.month
-
-        season_start = pend.instance(coc.utils.get_season_start(month=prev_month, year=prev_year))
-        season_end = pend.instance(coc.utils.get_season_end(month=prev_month, year=prev_year))
-
-        days = [season_start.add(days=i).to_date_string() for i in range((season_end - season_start).days)]
-
+    if season:
+        season_data = (await legend_seasons.get_days(tags=[player_tag], season=season)).get(player_tag, {})
         _holder = {}
-        for day in days:
-            _holder[day] = legend_data.get(day, {})
+        for day in legend_seasons.season_days(season):
+            _holder[day] = season_data.get(day, {})
         legend_data = _holder
 
     result = {
@@ -124,196 +170,165 @@ async def player_historical(player_tag: str, season: str, request: Request, resp
     month = season[-2:]
     season_start = coc.utils.get_season_start(month=int(month) - 1, year=int(year))
     season_end = coc.utils.get_season_end(month=int(month) - 1, year=int(year))
-    historical_data = await db_client.player_history.find({"$and" : [{"tag": player_tag}, {"time" : {"$gte" : season_start.timestamp()}}, {"time" : {"$lte" : season_end.timestamp()}}]}).sort("time", 1).to_list(length=25000)
-    breakdown = defaultdict(list)
-    for data in historical_data:
-        del data["_id"]
-        breakdown[data["type"]].append(data)
-
-    result = {}
-    for key, item in breakdown.items():
-        result[key] = item
-
-    return dict(result)
+    #the earliest events of the season are kept, read back sorted by type so each type is written out as one contiguous group
+    last_time = await player_history.last_kept_time(player_tag=player_tag, start=season_start.timestamp(), end=season_end.timestamp())
+    cursor = player_history.season_events(player_tag=player_tag, start=season_start.timestamp(), end=last_time)
+    return JSONStreamResponse(cursor, request=request, group_by="type")
 
 
 @router.get("/player/{player_tag}/warhits",
          name="War attacks done/defended by a player")
 async def player_warhits(player_tag: str, request: Request, response: Response, timestamp_start: int = 0, timestamp_end: int = 2527625513, limit: int = 50):
-    client = coc.Client(raw_attribute=True)
     player_tag = fix_tag(player_tag)
     if limit <= 0:
         return {"items": []}
     limit = min(limit, 100)
     START = pend.from_timestamp(timestamp_start, tz=pend.UTC).strftime('%Y%m%dT%H%M%S.000Z')
     END = pend.from_timestamp(timestamp_end, tz=pend.UTC).strftime('%Y%m%dT%H%M%S.000Z')
-    pipeline = [
-        {"$match": {"$or": [{"data.clan.members.tag": player_tag}, {"data.opponent.members.tag": player_tag}]}},
-        {"$match" : {"$and" : [{"data.preparationStartTime" : {"$gte" : START}}, {"data.preparationStartTime" : {"$lte" : END}}]}},
-        {"$unset": ["_id"]},
-        {"$project": {"data": "$data"}},
-        {"$sort" : {"data.preparationStartTime" : -1}}
-    ]
-    found_wars = set()
-    stats = {"items" : []}
-    local_limit = 0
-    wars = db_client.clan_wars.aggregate(pipeline, allowDiskUse=True)
-    try:
-        async for war in wars:
-            war = war.get("data")
-            war = coc.ClanWar(data=war, client=client)
-            war_unique_id = "-".join(sorted([war.clan_tag, war.opponent.tag])) + f"-{int(war.preparation_start_time.time.timestamp())}"
-            if war_unique_id in found_wars:
-                continue
-            if limit == local_limit:
-                break
-            found_wars.add(war_unique_id)
-            local_limit += 1
-
-            war_member = war.get_member(player_tag)
-            if war_member is None:
-                continue
-
-            war_data: dict = war._raw_data
-            war_data.pop("status_code", None)
-            war_data.pop("_response_retry", None)
-            war_data.pop("timestamp", None)
-            war_data.pop("timestamp", None)
-            del war_data["clan"]["members"]
-            del war_data["opponent"]["members"]
-            war_data["type"] = war.type
-
-            member_raw_data = war_member._raw_data
-            member_raw_data.pop("bestOpponentAttack", None)
-            member_raw_data.pop("attacks", None)
-
-            done_holder = {
-                "war_data": war_data,
-                "member_data" : member_raw_data,
-                "attacks": [],
-                "defenses" : []
-            }
-            for attack in war_member.attacks:
-                raw_attack: dict = attack._raw_data
-                raw_attack["fresh"] = attack.is_fresh_attack
-                defender_raw_data = attack.defender._raw_data
-                defender_raw_data.pop("attacks", None)
-                defender_raw_data.pop("bestOpponentAttack", None)
-                raw_attack["defender"] = defender_raw_data
-                raw_attack["attack_order"] = attack.order
-                done_holder["attacks"].append(raw_attack)
-
-            for defense in war_member.defenses:
-                raw_defense: dict = defense._raw_data
-                raw_defense["fresh"] = defense.is_fresh_attack
-
-                defender_raw_data = defense.attacker._raw_data
-                defender_raw_data.pop("attacks", None)
-                defender_raw_data.pop("bestOpponentAttack", None)
-
-                raw_defense["attacker"] = defender_raw_data
-                raw_defense["attack_order"] = defense.order
-                done_holder["defenses"].append(raw_defense)
-
-            stats["items"].append(done_holder)
-    finally:
-        await wars.close()
-    return stats
+    items = await war_index.get_warhits(player_tag=player_tag, start=START, end=END, limit=limit)
+    return {"items" : items}
 
 
 @router.get(
     path="/player/{player_tag}/raids",
     name="Raids participated in by a player"
 )
-async def player_raids(player_tag: str, request: Request, response: Response, limit: int = 1):
-    results = await db_client.capital.find({"data.members.tag" : player_tag}).sort({"data.endTime" : -1}).limit(limit=limit).to_list(length=None)
-    results = [r.get("data") for r in results]
-    return {"items" : results}
+async def player_raids(player_tag: str, request: Request, response: Response, limit: int = 1, timestamp_end: int = 9999999999):
+    player_tag = fix_tag(player_tag)
+    limit = min(max(limit, 1), 50)
+    END = pend.from_timestamp(timestamp_end, tz=pend.UTC).strftime('%Y%m%dT%H%M%S.000Z')
+
+    #only the player's own member entry and the district attacks they made are sent back, never the whole weekend
+    own_attacks = {"$filter" : {"input" : "$$district.attacks", "as" : "attack", "cond" : {"$eq" : ["$$attack.attacker.tag", player_tag]}}}
+    districts = {"$map" : {"input" : {"$ifNull" : ["$$raid.districts", []]}, "as" : "district",
+                           "in" : {"$mergeObjects" : ["$$district", {"attacks" : {"$ifNull" : [own_attacks, []]}}]}}}
+    attack_log = {"$map" : {"input" : {"$ifNull" : ["$data.attackLog", []]}, "as" : "raid",
+                            "in" : {"$mergeObjects" : ["$$raid", {"districts" : {"$filter" : {"input" : districts, "as" : "district",
+                                                                                             "cond" : {"$gt" : [{"$size" : "$$district.attacks"}, 0]}}}}]}}}
+    pipeline = [
+        {"$match" : {"$and" : [{"data.members.tag" : player_tag}, {"data.endTime" : {"$lt" : END}}]}},
+        {"$sort" : {"data.endTime" : -1}},
+        {"$limit" : limit},
+        {"$project" : {
+            "_id" : 0,
+            "clan_tag" : 1,
+            "data" : {"$mergeObjects" : [
+                "$data",
+                {"members" : {"$filter" : {"input" : "$data.members", "as" : "member", "cond" : {"$eq" : ["$$member.tag", player_tag]}}},
+                 "attackLog" : {"$filter" : {"input" : attack_log, "as" : "raid", "cond" : {"$gt" : [{"$size" : "$$raid.districts"}, 0]}}}}
+            ]}
+        }},
+        {"$unset" : "data.defenseLog"}
+    ]
+    results = await db_client.capital.aggregate(pipeline=pipeline).to_list(length=None)
+    items = [r.get("data") | {"clan_tag" : r.get("clan_tag")} for r in results]
+
+    next_timestamp_end = None
+    if len(items) == limit:
+        next_timestamp_end = int(coc.Timestamp(data=items[-1].get("endTime")).time.replace(tzinfo=pend.UTC).timestamp())
+    return {"items" : items, "next_timestamp_end" : next_timestamp_end}
+
+
+TO_DO_CONCURRENCY = 20
 
 
 @router.get("/player/to-do",
          name="List of in-game items to complete (legends, war, raids, etc)")
 async def player_to_do(request: Request, response: Response, player_tags: Annotated[List[str], Query(min_length=1, max_length=50)]):
+    player_tags = [fix_tag(player_tag) for player_tag in player_tags]
+    unique_tags = list(dict.fromkeys(player_tags))
+    semaphore = asyncio.Semaphore(TO_DO_CONCURRENCY)
+
+    # every player at once - the two mongo reads are batched and the player lookups fan out over the proxy
+    stats_results, timer_results, player_results = await asyncio.gather(
+        db_client.player_stats_db.find({"tag" : {"$in" : unique_tags}},
+                                       {"tag" : 1, "legends" : 1, "clan_games" : 1, "season_pass" : 1, "last_online" : 1}).to_list(length=None),
+        db_client.war_timer.find({"_id" : {"$in" : unique_tags}}).to_list(length=None),
+        asyncio.gather(*[fetch_proxy_json(f"players/{player_tag}", semaphore=semaphore) for player_tag in unique_tags])
+    )
+    stats_by_tag = {p.get("tag") : p for p in stats_results}
+    timer_by_tag = {t.pop("_id") : t for t in timer_results}
+    player_clan = {tag : (player_json or {}).get("clan", {}).get("tag") for tag, player_json in zip(unique_tags, player_results)}
+
+    # clan level data is shared by everyone in the clan, so it is fetched once per clan
+    clan_tags = list({clan_tag for clan_tag in player_clan.values() if clan_tag})
+    cwl_season = gen_games_season()
+
+    def group_loader(clan_tag: str):
+        return lambda: fetch_proxy_json(f"clans/{clan_tag}/currentwar/leaguegroup", semaphore=semaphore)
+
+    raid_results, group_results = await asyncio.gather(
+        asyncio.gather(*[fetch_proxy_json(f"clans/{clan_tag}/capitalraidseasons?limit=1", semaphore=semaphore) for clan_tag in clan_tags]),
+        asyncio.gather(*[cwl_cache.get_group(clan_tag=clan_tag, season=cwl_season, loader=group_loader(clan_tag), source="proxy") for clan_tag in clan_tags])
+    )
+
+    raid_by_clan = {}
+    for clan_tag, data in zip(clan_tags, raid_results):
+        if data and data.get("items"):
+            raid_weekend_entry = coc.RaidLogEntry(data=data.get("items")[0], client=None, clan_tag=clan_tag)
+            if raid_weekend_entry.end_time.seconds_until >= 0:
+                raid_by_clan[clan_tag] = raid_weekend_entry
+
+    # clans in the same group share the same round, so each war tag is only pulled once for the batch
+    round_by_clan = {}
+    for clan_tag, group_data in zip(clan_tags, group_results):
+        if group_data:
+            cwl_group = coc.ClanWarLeagueGroup(data=group_data, client=None)
+            last_round = cwl_group.rounds[-1] if len(cwl_group.rounds) == 1 or len(cwl_group.rounds) == cwl_group.number_of_rounds else cwl_group.rounds[-2]
+            round_by_clan[clan_tag] = last_round
+
+    async def war_loader(war_tags: list[str]):
+        results = await asyncio.gather(*[fetch_proxy_json(f"clanwarleagues/wars/{war_tag}", semaphore=semaphore) for war_tag in war_tags])
+        # league wars from the api carry neither, /cwl reads them from the same cache and needs both
+        for war_tag, war_json in zip(war_tags, results):
+            if war_json is not None:
+                war_json.setdefault("tag", war_tag)
+                war_json.setdefault("season", cwl_season)
+        return dict(zip(war_tags, results))
+
+    war_results = await cwl_cache.get_wars(war_tags=[war_tag for war_tags in round_by_clan.values() for war_tag in war_tags], loader=war_loader)
+
+    cwl_war_by_clan = {}
+    for war_json in war_results.values():
+        war = coc.ClanWar(data=war_json, client=None)
+        for clan_tag in (war.clan.tag, war.opponent.tag):
+            if clan_tag in round_by_clan:
+                cwl_war_by_clan[clan_tag] = war
+
     return_data = {"items" : []}
     for player_tag in player_tags:
-        player_tag = fix_tag(player_tag)
-
-        player_data = await db_client.player_stats_db.find_one({"tag" : player_tag},
-                                                               {"legends" : 1, "clan_games" : 1, "season_pass" : 1, "last_online" : 1})
-        player_data = player_data or {}
-
-        legends_data = player_data.get("legends", {}).get(gen_legend_date(), {})
-        games_data = player_data.get("clan_games", {}).get(gen_games_season(), {})
-        pass_data = player_data.get("season_pass", {}).get(gen_games_season(), {})
-        last_active_data = player_data.get("last_online")
-
-        player_clan_tag = None
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://proxy.clashk.ing/v1/players/{player_tag.replace('#', '%23')}") as response:
-                if response.status == 200:
-                    player_json = await response.json()
-                    player_clan_tag = player_json.get("clan", {}).get("tag")
+        player_data = stats_by_tag.get(player_tag, {})
+        player_clan_tag = player_clan.get(player_tag)
 
         raid_data = {}
-        if player_clan_tag:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"https://proxy.clashk.ing/v1/clans/{player_clan_tag.replace('#', '%23')}/capitalraidseasons?limit=1") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get("items"):
-                            raid_weekend_entry = coc.RaidLogEntry(data=data.get("items")[0], client=None, clan_tag=player_clan_tag)
-                            if raid_weekend_entry.end_time.seconds_until >= 0:
-                                raid_member = raid_weekend_entry.get_member(tag=player_tag)
-                                if raid_member:
-                                    raid_data = {
-                                        "attacks_done" : raid_member.attack_count,
-                                        "attack_limit" : raid_member.attack_limit + raid_member.bonus_attack_limit,
-                                    }
-
-
-        war_data = await db_client.war_timer.find_one({"_id" : player_tag}, {"_id" : 0})
-        war_data = war_data or {}
+        raid_weekend_entry = raid_by_clan.get(player_clan_tag)
+        if raid_weekend_entry is not None:
+            raid_member = raid_weekend_entry.get_member(tag=player_tag)
+            if raid_member:
+                raid_data = {
+                    "attacks_done" : raid_member.attack_count,
+                    "attack_limit" : raid_member.attack_limit + raid_member.bonus_attack_limit,
+                }
 
         cwl_data = {}
-
-        if player_clan_tag:
-            group_data = None
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"https://proxy.clashk.ing/v1/clans/{player_clan_tag.replace('#', '%23')}/currentwar/leaguegroup") as response:
-                    if response.status == 200:
-                        group_data = await response.json()
-
-            if group_data and group_data.get("season") == gen_games_season():
-                cwl_group = coc.ClanWarLeagueGroup(data=group_data, client=None)
-                last_round = cwl_group.rounds[-1] if len(cwl_group.rounds) == 1 or len(cwl_group.rounds) == cwl_group.number_of_rounds else cwl_group.rounds[-2]
-
-                our_war = None
-                for war_tag in last_round:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(f"https://proxy.clashk.ing/v1/clanwarleagues/wars/{war_tag.replace('#', '%23')}") as response:
-                            if response.status == 200:
-                                war_json = await response.json()
-                                war = coc.ClanWar(data=war_json, client=None)
-                                if player_clan_tag in [war.clan.tag, war.opponent.tag]:
-                                    our_war = war
-                                    break
-
-                war_member = our_war.get_member(tag=player_tag)
-                if war_member:
-                    cwl_data = {
-                        "attack_limit" : war.attacks_per_member,
-                        "attacks_done" : len(war_member.attacks)
-                    }
+        our_war = cwl_war_by_clan.get(player_clan_tag)
+        if our_war is not None:
+            war_member = our_war.get_member(tag=player_tag)
+            if war_member:
+                cwl_data = {
+                    "attack_limit" : our_war.attacks_per_member,
+                    "attacks_done" : len(war_member.attacks)
+                }
 
         return_data["items"].append({
             "player_tag" : player_tag,
             "current_clan" : player_clan_tag,
-            "legends" : legends_data,
-            "clan_games" : games_data,
-            "season_pass" : pass_data,
-            "last_active" : last_active_data,
+            "legends" : player_data.get("legends", {}).get(gen_legend_date(), {}),
+            "clan_games" : player_data.get("clan_games", {}).get(gen_games_season(), {}),
+            "season_pass" : player_data.get("season_pass", {}).get(gen_games_season(), {}),
+            "last_active" : player_data.get("last_online"),
             "raids" : raid_data,
-            "war" : war_data,
+            "war" : timer_by_tag.get(player_tag, {}),
             "cwl" : cwl_data
         })
 
@@ -351,6 +366,9 @@ async def player_wartimer(player_tag: str, request: Request, response: Response)
 @router.get("/player/search/{name}",
          name="Search for players by name")
 async def search_players(name: str, request: Request, response: Response):
+    if player_autocomplete.ready:
+        return {"items" : player_autocomplete.search(name=name, limit=25)}
+
     pipeline = [
         {
             "$search": {
@@ -379,8 +397,17 @@ async def full_search_players(name: str, request: Request, response: Response,
                         trophies:str =Query(default=None, description='A comma seperated value of low, high values like: 0,6000'),
                         donations:str =Query(default=None, description='A comma seperated value of low, high values like: 0,90000'),
                         limit: int = 25):
+    if player_names.ready:
+        ranges = {}
+        for field, value in (("townhall", townhall), ("expLevel", exp), ("trophies", trophies), ("donations", donations)):
+            if value is not None:
+                low, high = value.split(',')
+                ranges[field] = (int(low), int(high))
+        return {"items" : player_names.search(name=name, limit=min(limit, 1000), role=role, league=league, ranges=ranges)}
+
+    #index still building, the name is matched literally so it can't be used to run arbitrary regexes
     conditions = [
-        {"$regexMatch": {"input": "$$member.name", "regex": name, "options": "i"}},
+        {"$regexMatch": {"input": "$$member.name", "regex": re.escape(name), "options": "i"}},
     ]
 
     if role is not None:
@@ -490,91 +517,6 @@ async def player_join_leave(player_tag: str, request: Request, response: Respons
     ]
     result = await db_client.join_leave_history.aggregate(pipeline).to_list(length=None)
 
-    def process_clan_events(events):
-        """
-        Processes and cleans a list of clan events by:
-        1. Correcting the event sequence to ensure 'leave' events precede 'join' events for the same clan.
-        2. Sorting the events chronologically, prioritizing 'leave' events when times are equal.
-        3. Removing redundant 'leave' events that do not have a preceding 'join' event.
-
-        Args:
-            events (list): A list of event dictionaries. Each event should have at least the following keys:
-                           - 'type': 'join' or 'leave'
-                           - 'clan': Clan identifier
-                           - 'time': ISO 8601 timestamp string
-                           - 'tag': Player's tag
-                           - 'clan_name': Name of the clan
-
-        Returns:
-            list: A cleaned and sorted list of event dictionaries.
-        """
-        # Make a deep copy to avoid mutating the original list
-        events_copy = copy.deepcopy(events)
-        corrected_events = []
-
-        # Step 1: Correct the event sequence
-        while events_copy:
-            event = events_copy.pop(0)
-
-            if event.get("type") == "leave":
-                corrected_events.append(event)
-                continue
-
-            if event.get("type") == "join":
-                corrected_events.append(event)
-                clan_tag = event.get("tag")
-                clan_id = event.get("clan")
-
-                # Find the corresponding 'leave' event
-                leave_index = next(
-                    (i for i, e in enumerate(events_copy)
-                     if e.get("type") == "leave" and e.get("tag") == clan_tag and e.get("clan") == clan_id),
-                    None
-                )
-
-                if leave_index is not None:
-                    leave_event = events_copy.pop(leave_index)
-
-                    # Find the time of the next 'join' event
-                    next_join = next(
-                        (e for e in events_copy if e.get("type") == "join"),
-                        None
-                    )
-                    next_join_time = next_join["time"] if next_join else leave_event["time"]
-
-                    # Adjust the 'leave' event's time to match the next 'join' event's time
-                    leave_event["time"] = next_join_time
-                    corrected_events.append(leave_event)
-
-        # Step 2: Sort the corrected events
-        corrected_events_sorted = sorted(
-            corrected_events,
-            key=lambda e: (
-                e["time"],
-                0 if e["type"] == "leave" else 1  # Prioritize 'leave' over 'join' if times are equal
-            )
-        )
-
-        # Step 3: Remove redundant 'leave' events
-        final_events = []
-        active_clans = set()
-
-        for event in corrected_events_sorted:
-            clan_id = event.get("clan")
-
-            if event.get("type") == "join":
-                active_clans.add(clan_id)
-                final_events.append(event)
-            elif event.get("type") == "leave":
-                if clan_id in active_clans:
-                    active_clans.remove(clan_id)
-                    final_events.append(event)
-                else:
-                    # Redundant leave; optionally log or handle as needed
-                    final_events.append(event)
-
-        return final_events
-
     final_events = process_clan_events(result)
     final_events.reverse()
     return {"items": final_events}
@@ -4,6 +4,7 @@ from typing import  Union
 from slowapi import Limiter
 from slowapi.util import get_ipaddr
 from utils.utils import db_client, fix_tag
+from utils.streaming import JSONStreamResponse
 
 
 
@@ -13,8 +14,8 @@ router = APIRouter(tags=["Rankings"])
 async def live_legend_rankings(request: Request, response: Response, top_ranking: int = 1, lower_ranking: int = 200):
     if abs((lower_ranking + 1) - top_ranking) >= 5000:
         raise HTTPException(status_code=400, detail="Max 5000 rankings can be pulled at one time")
-    results = await db_client.legend_rankings.find({"rank" : {"$gte" : top_ranking, "$lte" : lower_ranking}}, {"_id" : 0}).to_list(length=None)
-    return results
+    cursor = db_client.legend_rankings.find({"rank" : {"$gte" : top_ranking, "$lte" : lower_ranking}}, {"_id" : 0}).sort("rank", 1)
+    return JSONStreamResponse(cursor, request=request)
 
 @router.get("/ranking/legends/{player_tag}")
 async def live_legend_rankings(player_tag: str, request: Request, response: Response):
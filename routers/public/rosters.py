@@ -11,6 +11,7 @@ from fastapi.templating import Jinja2Templates
 
 from starlette.requests import Request
 from utils.utils import fix_tag, db_client, upload_to_cdn
+from utils.server_clans import server_clans
 
 router = APIRouter(prefix="/roster", include_in_schema=False)
 
@@ -21,7 +22,7 @@ templates = Jinja2Templates(directory="templates")
 async def get_form(request: Request, token: str):
     roster = await db_client.rosters.find_one({"token" : token})
     server = roster.get("server_id")
-    clans = await db_client.clans_db.find({"server" : server}, {"name" : 1, "tag" : 1}).to_list(length=None)
+    clans = await server_clans.get_clans(server=server)
     clans = [f"{c.get('name')} ({c.get('tag')})" for c in clans]
     linked_clan = f"{roster.get('clan_name')} ({roster.get('clan_tag')})"
     server = await db_client.server_db.find_one({'server': server}, {'player_groups' : 1})
@@ -7,6 +7,8 @@ from typing import List, Annotated
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_ipaddr
 from utils.utils import fix_tag, db_client, gen_season_date, gen_games_season, gen_raid_date
+from utils.server_clans import server_clans
+from utils.snapshots import snapshot_first_page, snapshot_cursor_page, store_snapshot
 from statistics import mean, median
 from datetime import datetime, timedelta
 from pytz import utc
@@ -16,6 +18,9 @@ load_dotenv()
 
 router = APIRouter(tags=["Stat Endpoints"])
 
+#the global donation leaderboard is snapshotted this many ranks deep, cursors page through all of them
+GLOBAL_RANKING_DEPTH = 1000
+
 coc_client = coc.Client(key_names="keys for my windows pc", key_count=5, raw_attribute=True)
 
 
@@ -30,11 +35,18 @@ async def donations(request: Request, response: Response,
                            season: str = None,
                            tied_only: bool = True,
                            descending: bool = True,
-                           limit: int = 50):
+                           limit: int = 50,
+                           cursor: str = None):
     limit = min(limit, 500)
+    if cursor:
+        return await snapshot_cursor_page(name="donations", cursor=cursor, limit=limit)
+    snapshot_params = {"players" : players, "clans" : clans, "server" : server, "sort_field" : sort_field, "townhalls" : townhalls, "season" : season, "tied_only" : tied_only, "descending" : descending}
+    cached_page = await snapshot_first_page(name="donations", params=snapshot_params, limit=limit)
+    if cached_page is not None:
+        return cached_page
     season = gen_season_date() if season is None else season
     if server:
-        clans = await db_client.clans_db.distinct("tag", filter={"server" : server})
+        clans = await server_clans.get_tags(server=server)
 
     new_data = []
     clan_to_name = {}
@@ -43,7 +55,7 @@ async def donations(request: Request, response: Response,
 
     if players == clans == server == None:
         rank_results = await db_client.rankings.find({"donationsRank" : {"$ne" : None}}, {"_id" : 1, "name" : 1, "donations" : 1, "donationsRank" : 1, "donationsReceived" : 1})\
-            .sort("donationsRank", 1).limit(limit=limit).to_list(length=None)
+            .sort("donationsRank", 1).limit(limit=GLOBAL_RANKING_DEPTH).to_list(length=None)
         pipeline = [{"$match": {"tag": {"$in": [i.get("_id") for i in rank_results]}}},
                     {"$group": {"_id": "$tag", "th": {"$last": "$townhall"}}}]
         th_results = await db_client.attack_db.aggregate(pipeline).to_list(length=None)
@@ -123,7 +135,7 @@ async def donations(request: Request, response: Response,
         townhalls = [int(th) for th in townhalls if th.isnumeric()]
         new_data = [data for data in new_data if data.get("townhall") in townhalls]
 
-    new_data = sorted(new_data, key=lambda x: x.get(sort_field), reverse=descending)[:limit]
+    new_data = sorted(new_data, key=lambda x: x.get(sort_field), reverse=descending)
     for count, data in enumerate(new_data, 1):
         data["rank"] = count
 
@@ -138,8 +150,8 @@ async def donations(request: Request, response: Response,
             continue
         by_clan_totals.append({"tag": k, "name": clan_to_name.get(k), field_to_use: v.get(field_to_use)})
 
-    return {"items" : new_data, "totals" : totals,"clan_totals" : by_clan_totals,
-            "metadata" : {"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season}}
+    return await store_snapshot(name="donations", params=snapshot_params, items=new_data, totals=totals, clan_totals=by_clan_totals, limit=limit,
+                                metadata={"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season})
 
 
 
@@ -156,11 +168,18 @@ async def activity(request: Request, response: Response,
                            season: str = None,
                            tied_only: bool = True,
                            descending: bool = True,
-                           limit: int = 50):
+                           limit: int = 50,
+                           cursor: str = None):
     limit = min(limit, 500)
+    if cursor:
+        return await snapshot_cursor_page(name="activity", cursor=cursor, limit=limit)
+    snapshot_params = {"players" : players, "clans" : clans, "server" : server, "sort_field" : sort_field, "townhalls" : townhalls, "season" : season, "tied_only" : tied_only, "descending" : descending}
+    cached_page = await snapshot_first_page(name="activity", params=snapshot_params, limit=limit)
+    if cached_page is not None:
+        return cached_page
     season = gen_season_date() if season is None else season
     if server:
-        clans = await db_client.clans_db.distinct("tag", filter={"server" : server})
+        clans = await server_clans.get_tags(server=server)
 
     new_data = []
     clan_to_name = {}
@@ -224,7 +243,7 @@ async def activity(request: Request, response: Response,
         townhalls = [int(th) for th in townhalls if th.isnumeric()]
         new_data = [data for data in new_data if data.get("townhall") in townhalls]
 
-    new_data = sorted(new_data, key=lambda x: x.get(sort_field), reverse=descending)[:limit]
+    new_data = sorted(new_data, key=lambda x: x.get(sort_field), reverse=descending)
     for count, data in enumerate(new_data, 1):
         data["rank"] = count
 
@@ -237,8 +256,8 @@ async def activity(request: Request, response: Response,
             continue
         by_clan_totals.append({"tag": k, "name": clan_to_name.get(k), "activity": v.get("activity")})
 
-    return {"items" : new_data, "totals" : totals, "clan_totals" : by_clan_totals,
-            "metadata" : {"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season}}
+    return await store_snapshot(name="activity", params=snapshot_params, items=new_data, totals=totals, clan_totals=by_clan_totals, limit=limit,
+                                metadata={"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season})
 
 
 @router.get("/clan-games",
@@ -252,11 +271,18 @@ async def clan_games(request: Request, response: Response,
                            season: str = None,
                            tied_only: bool = True,
                            descending: bool = True,
-                           limit: int = 50):
+                           limit: int = 50,
+                           cursor: str = None):
     limit = min(limit, 500)
+    if cursor:
+        return await snapshot_cursor_page(name="clan-games", cursor=cursor, limit=limit)
+    snapshot_params = {"players" : players, "clans" : clans, "server" : server, "sort_field" : sort_field, "townhalls" : townhalls, "season" : season, "tied_only" : tied_only, "descending" : descending}
+    cached_page = await snapshot_first_page(name="clan-games", params=snapshot_params, limit=limit)
+    if cached_page is not None:
+        return cached_page
     season = gen_games_season() if season is None else season
     if server:
-        clans = await db_client.clans_db.distinct("tag", filter={"server" : server})
+        clans = await server_clans.get_tags(server=server)
     check_time = int(datetime.now().timestamp())
     current_season = gen_season_date()
     if season != current_season:
@@ -378,9 +404,9 @@ async def clan_games(request: Request, response: Response,
 
     if sort_field == "time_taken":
         new_data = [data for data in new_data if data.get("points") != 0]
-        new_data = sorted(new_data, key=lambda x: (x.get("points") >= 4000, -x.get(sort_field) if x.get(sort_field) != 0 else 999999999), reverse=descending)[:limit]
+        new_data = sorted(new_data, key=lambda x: (x.get("points") >= 4000, -x.get(sort_field) if x.get(sort_field) != 0 else 999999999), reverse=descending)
     else:
-     new_data = sorted(new_data, key=lambda x: x.get(sort_field), reverse=descending)[:limit]
+     new_data = sorted(new_data, key=lambda x: x.get(sort_field), reverse=descending)
     for count, data in enumerate(new_data, 1):
         data["rank"] = count
 
@@ -392,8 +418,8 @@ async def clan_games(request: Request, response: Response,
         if clan_to_name.get(k) is None:
             continue
         by_clan_totals.append({"tag" : k, "name" : clan_to_name.get(k), "points" : v.get("points")})
-    return {"items" : new_data, "totals" : totals, "clan_totals" : by_clan_totals,
-            "metadata" : {"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season}}
+    return await store_snapshot(name="clan-games", params=snapshot_params, items=new_data, totals=totals, clan_totals=by_clan_totals, limit=limit,
+                                metadata={"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season})
 
 
 
@@ -408,11 +434,18 @@ async def war_stats(request: Request, response: Response,
                            season_or_timestamp: str = None,
                            tied_only: bool = True,
                            descending: bool = True,
-                           limit: int = 50):
+                           limit: int = 50,
+                           cursor: str = None):
 
     limit = min(limit, 500)
+    if cursor:
+        return await snapshot_cursor_page(name="war-stats", cursor=cursor, limit=limit)
+    snapshot_params = {"players" : players, "clans" : clans, "server" : server, "sort_field" : sort_field, "townhalls" : townhalls, "season_or_timestamp" : season_or_timestamp, "tied_only" : tied_only, "descending" : descending}
+    cached_page = await snapshot_first_page(name="war-stats", params=snapshot_params, limit=limit)
+    if cached_page is not None:
+        return cached_page
     if server:
-        clans = await db_client.clans_db.distinct("tag", filter={"server" : server})
+        clans = await server_clans.get_tags(server=server)
 
     if season_or_timestamp is None:
         season_or_timestamp = gen_season_date()
@@ -632,9 +665,9 @@ async def war_stats(request: Request, response: Response,
                 return elem.get(split_field[0], [{}])[0].get(split_field[1], 0)
             except Exception:
                 return 0
-        new_data = sorted(player_stats, key=sorter, reverse=descending)[:limit]
+        new_data = sorted(player_stats, key=sorter, reverse=descending)
     else:
-        new_data = sorted(player_stats, key=lambda x: x.get(sort_field), reverse=descending)[:limit]
+        new_data = sorted(player_stats, key=lambda x: x.get(sort_field), reverse=descending)
 
     for count, data in enumerate(new_data, 1):
         data["rank"] = count
@@ -645,8 +678,8 @@ async def war_stats(request: Request, response: Response,
             continue
         hitrate = round((v.get("three_stars", 0) / (v.get("attacks", 0) if v.get("total_attacks") != 0 else 1)) * 100, 3)
         by_clan_totals.append({"tag" : k, "name" : clan_to_name.get(k), "hitrate" : hitrate} | dict(v))
-    return {"items" : new_data, "totals" : totals, "clan_totals" : by_clan_totals,
-            "metadata" : {"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season_or_timestamp}}
+    return await store_snapshot(name="war-stats", params=snapshot_params, items=new_data, totals=totals, clan_totals=by_clan_totals, limit=limit,
+                                metadata={"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "season" : season_or_timestamp})
 
 
 
@@ -661,11 +694,18 @@ async def capital_stats(request: Request, response: Response,
                            weekend_or_timestamp: str = None,
                            tied_only: bool = True,
                            descending: bool = True,
-                           limit: int = 50):
+                           limit: int = 50,
+                           cursor: str = None):
 
     limit = min(limit, 500)
+    if cursor:
+        return await snapshot_cursor_page(name="capital", cursor=cursor, limit=limit)
+    snapshot_params = {"players" : players, "clans" : clans, "server" : server, "sort_field" : sort_field, "weekend_or_timestamp" : weekend_or_timestamp, "tied_only" : tied_only, "descending" : descending}
+    cached_page = await snapshot_first_page(name="capital", params=snapshot_params, limit=limit)
+    if cached_page is not None:
+        return cached_page
     if server:
-        clans = await db_client.clans_db.distinct("tag", filter={"server" : server})
+        clans = await server_clans.get_tags(server=server)
 
     if weekend_or_timestamp is None:
         weekend_or_timestamp = gen_raid_date()
@@ -781,7 +821,7 @@ async def capital_stats(request: Request, response: Response,
         totals["total_medals"] += data.get("medals")
 
     stats = list(stats.values())
-    new_data = sorted(stats, key=lambda x: x.get(sort_field), reverse=descending)[:limit]
+    new_data = sorted(stats, key=lambda x: x.get(sort_field), reverse=descending)
 
     for count, data in enumerate(new_data, 1):
         data["rank"] = count
@@ -798,8 +838,8 @@ async def capital_stats(request: Request, response: Response,
         by_clan_totals.append({"tag" : k, "name" : clan_to_name.get(k)} | dict(v))
 
 
-    return {"items" : new_data, "totals" : totals, "clan_totals" : by_clan_totals,
-            "metadata" : {"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "weekend" : weekend_or_timestamp}}
+    return await store_snapshot(name="capital", params=snapshot_params, items=new_data, totals=totals, clan_totals=by_clan_totals, limit=limit,
+                                metadata={"sort_order" : ("descending" if descending else "ascending"), "sort_field" : sort_field, "weekend" : weekend_or_timestamp})
 
 
 
@@ -1,13 +1,18 @@
-import copy
 from typing import Optional
 from fastapi import Request, APIRouter
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
-import aiohttp
+from fastapi.responses import HTMLResponse, JSONResponse
+from utils.utils import fix_tag, redis, fetch_proxy_json
+from utils.war_log import war_by_end_time
+import coc
+import pendulum as pend
 
 router = APIRouter(tags=["War Timeline"])
 templates = Jinja2Templates(directory="templates")
 
+# ended wars don't change, the ttl only bounds how long a page survives a template change
+PAGE_TTL = 7 * 86400
+
 def extract_attacks(war_data):
     all_attacks = []
     clan = war_data["clan"]
@@ -52,29 +57,28 @@ def initialize_member_stats(members):
     return member_stats
 
 def compute_timeline(war_data):
+    """
+    The war as an initial state plus one step per attack, each step only holds the attack and the running totals.
+    Member attack/defense counts aren't repeated per step, they follow from the attacks (the attacker used one, the
+    defender took one) and are rebuilt by the page, so the size grows with the attacks and not attacks x members.
+    """
     clan = war_data["clan"]
     opponent = war_data["opponent"]
-    attacks_per_member = war_data.get("attacksPerMember", 1)
     team_size = war_data["teamSize"]
 
     all_attacks = extract_attacks(war_data)
 
     # Initialize cumulative stats
     clan_stars = 0
-    clan_destruction = 0.0
     clan_attacks_used = 0
 
     opponent_stars = 0
-    opponent_destruction = 0.0
     opponent_attacks_used = 0
 
-    clan_members_stats = initialize_member_stats(clan["members"])
-    opponent_members_stats = initialize_member_stats(opponent["members"])
-
     sum_clan_destruction = 0.0
     sum_opponent_destruction = 0.0
 
-    war_timeline = [{
+    initial = {
         "order": 0,
         "clan_stars": 0,
         "clan_destruction": 0.0,
@@ -82,71 +86,71 @@ def compute_timeline(war_data):
         "opponent_stars": 0,
         "opponent_destruction": 0.0,
         "opponent_attacks_used": 0,
-        "clan_members": copy.deepcopy(list(clan_members_stats.values())),
-        "opponent_members": copy.deepcopy(list(opponent_members_stats.values())),
+        "clan_members": list(initialize_member_stats(clan["members"]).values()),
+        "opponent_members": list(initialize_member_stats(opponent["members"]).values()),
         "last_attack": None
-    }]
+    }
 
+    steps = []
     for attack in all_attacks:
         if attack["attackerClan"] == "clan":
             clan_stars += attack["stars"]
             sum_clan_destruction += attack["destructionPercentage"]
             clan_attacks_used += 1
-
-            if attack["attackerTag"] in clan_members_stats:
-                clan_members_stats[attack["attackerTag"]]["attacks_used"] += 1
-            if attack["defenderTag"] in opponent_members_stats:
-                opponent_members_stats[attack["defenderTag"]]["defenses_used"] += 1
-
         else:
             opponent_stars += attack["stars"]
             sum_opponent_destruction += attack["destructionPercentage"]
             opponent_attacks_used += 1
 
-            if attack["attackerTag"] in opponent_members_stats:
-                opponent_members_stats[attack["attackerTag"]]["attacks_used"] += 1
-            if attack["defenderTag"] in clan_members_stats:
-                clan_members_stats[attack["defenderTag"]]["defenses_used"] += 1
-
-        clan_destruction = (sum_clan_destruction / (team_size * 100)) * 100
-        opponent_destruction = (sum_opponent_destruction / (team_size * 100)) * 100
-
-        war_timeline.append({
+        steps.append({
             "order": attack["order"],
             "clan_stars": clan_stars,
-            "clan_destruction": clan_destruction,
+            "clan_destruction": (sum_clan_destruction / (team_size * 100)) * 100,
             "clan_attacks_used": clan_attacks_used,
             "opponent_stars": opponent_stars,
-            "opponent_destruction": opponent_destruction,
+            "opponent_destruction": (sum_opponent_destruction / (team_size * 100)) * 100,
             "opponent_attacks_used": opponent_attacks_used,
-            "clan_members": copy.deepcopy(list(clan_members_stats.values())),
-            "opponent_members": copy.deepcopy(list(opponent_members_stats.values())),
             "last_attack": attack
         })
 
-    return war_timeline
+    return {"initial": initial, "steps": steps}
+
+def page_key(clan_tag: str, end_time: str):
+    return f"timeline:page:{clan_tag}:{end_time}"
+
 
 @router.get("/timeline/{clan_tag}", response_class=HTMLResponse)
 @router.get("/timeline/{clan_tag}/{timestamp}", response_class=HTMLResponse)
-async def get_war(request: Request, clan_tag: str, timestamp: Optional[str] = None):
+async def get_war(request: Request, clan_tag: str, timestamp: Optional[str] = None, format: Optional[str] = None):
+    clan_tag = fix_tag(clan_tag)
     war_data = None
     if timestamp is None:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://proxy.clashk.ing/v1/clans/{clan_tag.replace('#','%23')}/currentwar") as response:
-                if response.status == 200:
-                    war_data = await response.json()
+        war_data = await fetch_proxy_json(f"clans/{clan_tag}/currentwar")
     else:
-        # Fetch specific war by timestamp
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                    f"https://api.clashk.ing/war/{clan_tag.replace('#', '%23')}/previous/{timestamp}") as response:
-                if response.status == 200:
-                    war_data = await response.json()
+        # links to past wars carry the exact end time, so most of them are served without touching mongo
+        if format != "json":
+            cached = await redis.get(page_key(clan_tag, timestamp))
+            if cached is not None:
+                return HTMLResponse(cached)
+        try:
+            end_time = coc.Timestamp(data=timestamp).time.replace(tzinfo=pend.UTC)
+        except ValueError:
+            end_time = None
+        if end_time is not None:
+            war = await war_by_end_time(clan_tag=clan_tag, end_time=end_time)
+            war_data = war.get("data") if war else None
 
     # If no war_data found even after all logic
-    if war_data is None:
+    if not war_data or war_data.get("state") == "notInWar":
         return HTMLResponse("<h1>No war data available</h1>", status_code=404)
 
+    # an ended war can't change anymore, its page is rendered once
+    ended = war_data.get("state") == "warEnded" and format != "json"
+    if ended:
+        cached = await redis.get(page_key(clan_tag, war_data.get("endTime")))
+        if cached is not None:
+            return HTMLResponse(cached)
+
     # Ensure clan/opponent orientation
     if war_data["clan"]["tag"] != clan_tag:
         tmp = war_data["clan"]
@@ -155,9 +159,19 @@ async def get_war(request: Request, clan_tag: str, timestamp: Optional[str] = No
 
     war_timeline = compute_timeline(war_data)
 
+    if format == "json":
+        side = lambda c: {"tag": c.get("tag"), "name": c.get("name"), "badgeUrls": c.get("badgeUrls"), "clanLevel": c.get("clanLevel")}
+        return JSONResponse({
+            "clan": side(war_data["clan"]),
+            "opponent": side(war_data["opponent"]),
+            "teamSize": war_data["teamSize"],
+            "attacksPerMember": war_data.get("attacksPerMember", 1),
+            "timeline": war_timeline
+        })
+
     wars_available = []
 
-    return templates.TemplateResponse(
+    page = templates.TemplateResponse(
         "war.html",
         {
             "request": request,
@@ -166,7 +180,12 @@ async def get_war(request: Request, clan_tag: str, timestamp: Optional[str] = No
             "opponent": war_data["opponent"],
             "attacks_per_member": war_data.get("attacksPerMember", 1),
             "wars_available": wars_available,
-            "selected_timestamp": timestamp,
+            # a cached page is shared by every request for the war, so it selects the war's own end time
+            "selected_timestamp": war_data.get("endTime") if ended else timestamp,
             "clan_tag": clan_tag
         }
-    )
\ No newline at end of file
+    )
+    # only under the war's own end time, the +-5 minute lookup would otherwise let anyone write a key per timestamp
+    if ended:
+        await redis.set(page_key(clan_tag, war_data.get("endTime")), page.body, ex=PAGE_TTL)
+    return page
@@ -1,16 +1,28 @@
 
+import asyncio
 import coc
 import pendulum as pend
-from fastapi import  Request, Response, HTTPException
-from fastapi import APIRouter
+from fastapi import  Request, Response, HTTPException, Depends
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+from typing import List
 from slowapi import Limiter
 from slowapi.util import get_ipaddr
 from utils.utils import fix_tag, db_client, gen_season_date
-from datetime import datetime, timedelta
+from utils import cwl_cache
+from utils.cwl_standings import get_standings
+from utils.fieldsets import Fields, fields_param
+from utils.fast_response import TrustedJSONResponse
+from utils.streaming import dumps
+from utils.war_feed import CLOSED, war_feed
+from utils.war_log import previous_wars_pipeline, summary_expression, war_by_end_time
+from datetime import datetime
 
 
 router = APIRouter(tags=["War Endpoints"])
 CWL_SEASON_DATE_CUTOFF = datetime(2026, 6, 14).date()
+MAX_LIVE_CLANS = 100
+LIVE_KEEPALIVE = 15
 
 
 def normalize_cwl_season(season: str) -> str:
@@ -28,62 +40,57 @@ def normalize_cwl_season(season: str) -> str:
 @router.get("/war/{clan_tag}/previous",
          tags=["War Endpoints"],
          name="Previous Wars for a clan")
-async def war_previous(clan_tag: str, request: Request, response: Response,  timestamp_start: int = 0, timestamp_end: int = 9999999999, limit: int= 50):
+async def war_previous(clan_tag: str, request: Request, response: Response,  timestamp_start: int = 0, timestamp_end: int = 9999999999, limit: int= 50,
+                       summary: bool = Query(default=False, description="War log view, war level totals without the member rosters"),
+                       fields: Fields = Depends(fields_param)):
     clan_tag = fix_tag(clan_tag)
     START = pend.from_timestamp(timestamp_start, tz=pend.UTC).strftime('%Y%m%dT%H%M%S.000Z')
     END = pend.from_timestamp(timestamp_end, tz=pend.UTC).strftime('%Y%m%dT%H%M%S.000Z')
 
-    full_wars = await db_client.clan_wars.find({"$and" : [
-        {"$or" : [{"data.clan.tag" : clan_tag}, {"data.opponent.tag" : clan_tag}]},
-        {"data.preparationStartTime" : {"$gte" : START}},
-        {"data.preparationStartTime" : {"$lte" : END}}
-    ]}).to_list(length=None)
-    found_ids = set()
-    new_wars = []
-    for war in full_wars:
-        id = war.get("data").get("preparationStartTime")
-        if id in found_ids:
-            continue
-        try:
-            del war["_response_retry"]
-        except:
-            pass
-        new_wars.append(war.get("data"))
-        found_ids.add(id)
+    if limit <= 0:
+        return TrustedJSONResponse({"items" : []})
 
-    actual_results = sorted(new_wars, key=lambda x: x.get("endTime", 0), reverse=True)
-    return {"items" : actual_results[:limit]}
+    #newest first, deduped and limited in mongo, only the wars on the page ever leave the database
+    if summary:
+        projection = {"_id" : 0, "data" : summary_expression(clan_tag=clan_tag)}
+    else:
+        projection = fields.projection(prefix="data.", always=["data.preparationStartTime", "data.endTime"])
+    pipeline = previous_wars_pipeline(clan_tag=clan_tag, start=START, end=END, limit=limit, projection=projection)
+    actual_results = await db_client.clan_wars.aggregate(pipeline=pipeline).to_list(length=None)
+    return TrustedJSONResponse({"items" : fields.filter(actual_results)})
 
 
 @router.get("/war/{clan_tag}/previous/{end_time}",
          tags=["War Endpoints"],
          name="Previous War at an endtime, for a clan")
-async def war_previous_time(clan_tag: str, end_time: str, request: Request, response: Response):
+async def war_previous_time(clan_tag: str, end_time: str, request: Request, response: Response, fields: Fields = Depends(fields_param)):
     end_time = coc.Timestamp(data=end_time).time.replace(tzinfo=pend.UTC)
-    lower_end_time = end_time - timedelta(minutes=5)
-    higher_end_time = end_time + timedelta(minutes=5)
-
     clan_tag = fix_tag(clan_tag)
-    war = await db_client.clan_wars.find_one({"$and" : [{"$or" : [{"data.clan.tag" : clan_tag}, {"data.opponent.tag" : clan_tag}]},
-                                                        {"data.endTime" : {"$gte" : lower_end_time.strftime('%Y%m%dT%H%M%S.000Z')}},
-                                                        {"data.endTime" : {"$lte" : higher_end_time.strftime('%Y%m%dT%H%M%S.000Z')}}]})
+    war = await war_by_end_time(clan_tag=clan_tag, end_time=end_time, projection=fields.projection(prefix="data."))
     if war is None:
         raise HTTPException(status_code=404, detail="War Not Found")
-    return war.get("data", {})
+    return TrustedJSONResponse(fields.filter(war.get("data", {})))
 
 
 
 @router.get("/war/{clan_tag}/basic",
          tags=["War Endpoints"],
          name="Basic War Info, Bypasses Private War Log if Possible")
-async def basic_war_info(clan_tag: str, request: Request, response: Response):
+async def basic_war_info(clan_tag: str, request: Request, response: Response,
+                         summary: bool = Query(default=False, description="War log view, war level totals without the member rosters"),
+                         fields: Fields = Depends(fields_param)):
+    clan_tag = fix_tag(clan_tag)
     now = datetime.utcnow().timestamp() - 183600
-    result = await db_client.clan_wars.find({"$and" : [{"clans" : fix_tag(clan_tag)}, {"custom_id": None}, {"endTime" : {"$gte" : now}}]}).sort({"endTime" : -1}).to_list(length=None)
+    projection = {"_id" : 0, "summary" : summary_expression(clan_tag=clan_tag)} if summary else fields.projection()
+    result = await db_client.clan_wars.find({"$and" : [{"clans" : clan_tag}, {"custom_id": None}, {"endTime" : {"$gte" : now}}]},
+                                            projection).sort({"endTime" : -1}).limit(1).to_list(length=None)
     result = result or None
     if result:
         result = result[0]
-        del result["_id"]
-    return result
+        result.pop("_id", None)
+        if summary:
+            result = fields.filter(result.get("summary"))
+    return TrustedJSONResponse(result)
 
 
 
@@ -104,23 +111,81 @@ async def cwl_group(clan_tag: str, request: Request, response: Response):
 async def cwl(clan_tag: str, season: str, request: Request, response: Response):
     clan_tag = fix_tag(clan_tag)
     season = normalize_cwl_season(season)
-    cwl_result = await db_client.cwl_groups.find_one({"$and" : [{"data.clans.tag" : clan_tag}, {"data.season" : season}]})
 
+    async def group_loader():
+        group = await db_client.cwl_groups.find_one({"$and" : [{"data.clans.tag" : clan_tag}, {"data.season" : season}]}, {"data" : 1})
+        return group.get("data") if group else None
+
+    async def war_loader(war_tags: list[str]):
+        wars = await db_client.clan_wars.find({"$and" : [{"data.tag" : {"$in" : war_tags}}, {"data.season" : season}]}, {"data" : 1}).to_list(length=None)
+        return {w.get("data").get("tag") : w.get("data") for w in wars}
+
+    cwl_result = await cwl_cache.get_group(clan_tag=clan_tag, season=season, loader=group_loader, source="mongo")
     if cwl_result is None:
         raise HTTPException(status_code=404, detail="No CWL Data Found")
-    rounds = cwl_result.get("data").get("rounds")
+    rounds = cwl_result.get("rounds")
     war_tags = []
     for round in rounds:
         for tag in round.get("warTags"):
             war_tags.append(tag)
-    matching_wars = await db_client.clan_wars.find({"$and" : [{"data.tag" : {"$in" : war_tags}}, {"data.season" : season}]}).to_list(length=None)
-    matching_wars = {w.get("data").get("tag") : w.get("data") for w in matching_wars}
+    matching_wars = await cwl_cache.get_wars(war_tags=war_tags, loader=war_loader)
     for r_count, round in enumerate(rounds):
         for count, tag in enumerate(round.get("warTags")):
             war_data = matching_wars.get(tag)
             if war_data is None:
                 war_data = {"tag": tag}
             rounds[r_count].get("warTags")[count] = war_data
-    cwl_result = cwl_result["data"]
     cwl_result["rounds"] = rounds
     return cwl_result
+
+
+
+@router.get("/cwl/{clan_tag}/{season}/standings",
+         tags=["War Endpoints"],
+         name="Cwl rounds, war summaries & standings for a clan's group in a season (yyyy-mm)")
+async def cwl_standings(clan_tag: str, season: str, request: Request, response: Response):
+    clan_tag = fix_tag(clan_tag)
+    season = normalize_cwl_season(season)
+    result = await get_standings(clan_tag=clan_tag, season=season)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No CWL Data Found")
+    return TrustedJSONResponse(result)
+
+
+
+def live_war_response(request: Request, clan_tags: list[str]):
+    async def events():
+        queue = war_feed.subscribe(clan_tags)
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    #comment lines keep proxies from closing an idle connection
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+                if (event, data) == CLOSED:
+                    break
+        finally:
+            war_feed.unsubscribe(queue, clan_tags)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/war/{clan_tag}/live",
+         tags=["War Endpoints"],
+         name="Live war events for a clan as server-sent events, a war event on state changes & an attack event per new attack")
+async def war_live(clan_tag: str, request: Request):
+    return live_war_response(request=request, clan_tags=[fix_tag(clan_tag)])
+
+
+@router.get("/war/live",
+         tags=["War Endpoints"],
+         name="Live war events for a set of clans as server-sent events (max 100 clans)")
+async def war_live_bulk(request: Request, clan_tags: List[str] = Query(...)):
+    clan_tags = list(dict.fromkeys(fix_tag(tag) for tag in clan_tags))
+    if len(clan_tags) > MAX_LIVE_CLANS:
+        raise HTTPException(status_code=400, detail=f"Max {MAX_LIVE_CLANS} clans can be followed at one time")
+    return live_war_response(request=request, clan_tags=clan_tags)
@@ -0,0 +1,239 @@
+import asyncio
+import coc
+import csv
+import io
+import orjson
+import os
+import pendulum as pend
+import tempfile
+import xlsxwriter
+
+from datetime import datetime
+from enum import Enum
+from fastapi import Request, Response, HTTPException, APIRouter, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Annotated, AsyncIterable
+from utils.utils import fix_tag, db_client
+from utils.snapshots import keep_snapshot, snapshot_cursor_page
+from routers.public.stats import donations, activity, clan_games, war_stats
+
+
+router = APIRouter(tags=["Export Endpoints"])
+
+CSV_FLUSH_ROWS = 500
+XLSX_BATCH_ROWS = 500
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class ExportFormat(str, Enum):
+    csv = "csv"
+    xlsx = "xlsx"
+
+
+STAT_VIEWS = {
+    "donations": (donations, [
+        ("Rank", "rank"), ("Name", "name"), ("Tag", "tag"), ("Townhall", "townhall"), ("Clan", "clan_tag"),
+        ("Donated", "donations"), ("Received", "donationsReceived")
+    ]),
+    "activity": (activity, [
+        ("Rank", "rank"), ("Name", "name"), ("Tag", "tag"), ("Townhall", "townhall"), ("Clan", "clan_tag"),
+        ("Activity", "activity"), ("Last Online", "last_online")
+    ]),
+    "clan-games": (clan_games, [
+        ("Rank", "rank"), ("Name", "name"), ("Tag", "tag"), ("Townhall", "townhall"), ("Clan", "clan_tag"),
+        ("Points", "points"), ("Time Taken", "time_taken")
+    ]),
+    "war-stats": (war_stats, [
+        ("Rank", "rank"), ("Name", "name"), ("Tag", "tag"), ("Townhall", "townhall"),
+        ("Attacks", "hit_rates.0.total_attacks"), ("Stars", "hit_rates.0.total_stars"),
+        ("Destruction", "hit_rates.0.total_destruction"), ("3 Stars", "hit_rates.0.three_stars"),
+        ("2 Stars", "hit_rates.0.two_stars"), ("1 Stars", "hit_rates.0.one_stars"), ("0 Stars", "hit_rates.0.zero_stars"),
+        ("Hitrate", "hit_rates.0.hitrate"), ("Defenses", "defense_rates.0.total_attacks"),
+        ("Defense Rate", "defense_rates.0.hitrate")
+    ]),
+}
+
+JOIN_LEAVE_COLUMNS = [("Time", "time"), ("Type", "type"), ("Name", "name"), ("Tag", "tag"), ("Townhall", "th"), ("Clan", "clan")]
+
+HISTORY_COLUMNS = [("Time", "time"), ("Type", "type"), ("Name", "name"), ("Tag", "tag"), ("Clan", "clan"),
+                   ("Previous Value", "p_value"), ("Value", "value")]
+
+
+def get_path(item: dict, path: str):
+    for part in path.split("."):
+        if isinstance(item, list):
+            item = item[int(part)] if part.isnumeric() and int(part) < len(item) else None
+        elif isinstance(item, dict):
+            item = item.get(part)
+        else:
+            return None
+    return item
+
+
+def to_cell(value):
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value).decode()
+    return value
+
+
+async def close_rows(rows: AsyncIterable[dict]):
+    # motor cursors have close(), generators wrapping one close it in their own finally when aclose()d
+    close = getattr(rows, "aclose", None) or getattr(rows, "close", None)
+    if close is not None:
+        await close()
+
+
+async def csv_stream(columns: list, rows: AsyncIterable[dict]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _ in columns])
+    count = 0
+    try:
+        async for row in rows:
+            writer.writerow([to_cell(get_path(row, path)) for _, path in columns])
+            count += 1
+            if count % CSV_FLUSH_ROWS == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+    finally:
+        await close_rows(rows)
+    yield buffer.getvalue().encode()
+
+
+def write_rows(worksheet, first_row: int, rows: list[list]):
+    for row_num, row in enumerate(rows, start=first_row):
+        worksheet.write_row(row_num, 0, row)
+
+
+async def xlsx_stream(columns: list, rows: AsyncIterable[dict]):
+    # xlsx is a zip, so nothing can be sent before the last row is written - constant_memory flushes each
+    # row to disk as it is written and the finished file is then streamed back in chunks
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "remove_timezone": True,
+                                              "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+        worksheet = workbook.add_worksheet()
+        bold = workbook.add_format({"bold": True})
+        worksheet.write_row(0, 0, [header for header, _ in columns], bold)
+        # xlsxwriter formats and writes every cell to disk, rows are handed to a thread in batches to keep that off the event loop
+        row_num, batch = 1, []
+        try:
+            async for row in rows:
+                batch.append([to_cell(get_path(row, path)) for _, path in columns])
+                if len(batch) == XLSX_BATCH_ROWS:
+                    await asyncio.to_thread(write_rows, worksheet, row_num, batch)
+                    row_num, batch = row_num + len(batch), []
+        finally:
+            await close_rows(rows)
+        await asyncio.to_thread(write_rows, worksheet, row_num, batch)
+        await asyncio.to_thread(workbook.close)
+
+        with open(path, "rb") as file:
+            while chunk := await asyncio.to_thread(file.read, FILE_CHUNK_SIZE):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def export_response(file_name: str, format: ExportFormat, columns: list, rows: AsyncIterable[dict]):
+    if format == ExportFormat.xlsx:
+        content = xlsx_stream(columns=columns, rows=rows)
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        content = csv_stream(columns=columns, rows=rows)
+        media_type = "text/csv"
+    return StreamingResponse(content, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}.{format.value}"'})
+
+
+async def iterate_snapshot(name: str, first_page: dict):
+    # the stat handlers return the first page of a ranked snapshot, walk the rest of it for the full family
+    page = first_page
+    while True:
+        for item in page["items"]:
+            yield item
+        if not page.get("next_cursor"):
+            break
+        # a slow client could outlive the snapshot, the ttl restarts per page and an expired one fails the download
+        await keep_snapshot(name=name, cursor=page["next_cursor"])
+        page = await snapshot_cursor_page(name=name, cursor=page["next_cursor"], limit=500)
+
+
+async def unix_to_datetime(cursor):
+    try:
+        async for row in cursor:
+            row["time"] = datetime.utcfromtimestamp(row["time"]) if isinstance(row.get("time"), (int, float)) else row.get("time")
+            yield row
+    finally:
+        await cursor.close()
+
+
+@router.get("/export/stats/{view}",
+         name="Export a stats leaderboard as csv or xlsx (view: donations, activity, clan-games, war-stats)")
+async def export_stats(view: str, request: Request, response: Response,
+                       players: Annotated[List[str], Query(max_length=50)]=None,
+                       clans: Annotated[List[str], Query(max_length=25)]=None,
+                       server: int = None,
+                       townhalls: Annotated[List[str], Query(max_length=15)]=None,
+                       season: str = None,
+                       tied_only: bool = True,
+                       format: ExportFormat = ExportFormat.xlsx):
+    if view not in STAT_VIEWS:
+        raise HTTPException(status_code=404, detail=f"Unknown stat view, use one of {', '.join(STAT_VIEWS)}")
+    handler, columns = STAT_VIEWS[view]
+    season_param = "season_or_timestamp" if view == "war-stats" else "season"
+    result = await handler(request=request, response=response, players=players, clans=clans, server=server,
+                           townhalls=townhalls, tied_only=tied_only, limit=500, **{season_param: season})
+    return export_response(file_name=f"{view}-{result['metadata']['season']}", format=format, columns=columns,
+                           rows=iterate_snapshot(name=view, first_page=result))
+
+
+@router.get("/export/clan/{clan_tag}/join-leave",
+         name="Export join leave history for a clan as csv or xlsx")
+async def export_clan_join_leave(clan_tag: str, request: Request, response: Response, timestamp_start: int = 0,
+                                 time_stamp_end: int = 9999999999, format: ExportFormat = ExportFormat.xlsx):
+    clan_tag = fix_tag(clan_tag)
+    cursor = db_client.join_leave_history.find(
+        {"$and": [
+            {"clan": clan_tag},
+            {"time": {"$gte": pend.from_timestamp(timestamp=timestamp_start, tz=pend.UTC)}},
+            {"time": {"$lte": pend.from_timestamp(timestamp=time_stamp_end, tz=pend.UTC)}}
+        ]
+    }, {"_id": 0}).sort({"time": -1}).batch_size(1000)
+    return export_response(file_name=f"join-leave-{clan_tag.strip('#')}", format=format, columns=JOIN_LEAVE_COLUMNS, rows=cursor)
+
+
+@router.get("/export/clan/{clan_tag}/historical",
+         name="Export player events in a clan as csv or xlsx")
+async def export_clan_historical(clan_tag: str, request: Request, response: Response, timestamp_start: int = 0,
+                                 time_stamp_end: int = 9999999999, format: ExportFormat = ExportFormat.xlsx):
+    clan_tag = fix_tag(clan_tag)
+    cursor = db_client.player_history.find(
+        {"$and": [
+            {"clan": clan_tag},
+            {"time": {"$gte": timestamp_start}},
+            {"time": {"$lte": time_stamp_end}}
+        ]
+        }, {"_id": 0}).sort({"time": -1}).batch_size(1000)
+    return export_response(file_name=f"history-{clan_tag.strip('#')}", format=format, columns=HISTORY_COLUMNS,
+                           rows=unix_to_datetime(cursor))
+
+
+@router.get("/export/player/{player_tag}/historical/{season}",
+         name="Export a player's events in a season as csv or xlsx")
+async def export_player_historical(player_tag: str, season: str, request: Request, response: Response,
+                                   format: ExportFormat = ExportFormat.xlsx):
+    player_tag = fix_tag(player_tag)
+    year, month = season.split("-")
+    season_start = coc.utils.get_season_start(month=int(month) - 1, year=int(year))
+    season_end = coc.utils.get_season_end(month=int(month) - 1, year=int(year))
+    cursor = db_client.player_history.find(
+        {"$and": [
+            {"tag": player_tag},
+            {"time": {"$gte": season_start.timestamp()}},
+            {"time": {"$lte": season_end.timestamp()}}
+        ]}, {"_id": 0}).sort("time", 1).batch_size(1000)
+    return export_response(file_name=f"history-{player_tag.strip('#')}-{season}", format=format, columns=HISTORY_COLUMNS,
+                           rows=unix_to_datetime(cursor))
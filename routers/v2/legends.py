@@ -8,6 +8,8 @@ from fastapi import APIRouter, Query
 from typing import Annotated, List
 from datetime import datetime, timedelta
 from utils.utils import fix_tag, db_client, token_verify, limiter, remove_id_fields
+from utils import legend_seasons
+from utils.fast_response import TrustedJSONResponse
 
 
 
@@ -72,7 +74,7 @@ async def legend_stats_day(day: str, request: Request, response: Response, playe
     # Execute the aggregation
     combined_data = await db_client.player_stats_db.aggregate(pipeline).to_list(length=None)
 
-    return remove_id_fields(combined_data)
+    return TrustedJSONResponse(remove_id_fields(combined_data))
 
 
 @router.get("/legends/players/season/{season}",
@@ -86,7 +88,7 @@ async def legend_stats_season(season: str, request: Request, response: Response,
             "$project": {
                 "name": 1,
                 "townhall": 1,
-                "legends": 1,
+                "legends.streak": 1,
                 "tag": 1,
                 "_id": 0
             }
@@ -129,17 +131,13 @@ async def legend_stats_season(season: str, request: Request, response: Response,
 
     # Execute the aggregation
     combined_data = await db_client.player_stats_db.aggregate(pipeline).to_list(length=None)
-    year, month = season.split('-')
-    season_start = coc.utils.get_season_start(month=int(month) - 1, year=int(year))
-    season_end = coc.utils.get_season_end(month=int(month) - 1, year=int(year))
-    delta = season_end - season_start
-    days = [season_start + timedelta(days=i) for i in range(delta.days)]
-    days = set([day.strftime('%Y-%m-%d') for day in days])
+    days = set(legend_seasons.season_days(season))
+    season_data = await legend_seasons.get_days(tags=[player.get("tag") for player in combined_data], season=season)
 
     for player in combined_data:
         player['streak'] = player.get('legends', {}).get('streak', 0)
         new_data = {}
-        for key, value in player.get("legends", {}).items():
+        for key, value in season_data.get(player.get("tag"), {}).items():
             if key not in days:
                 continue
             if 'new_defenses' in value or 'new_attacks' in value:
@@ -147,4 +145,4 @@ async def legend_stats_season(season: str, request: Request, response: Response,
                 value["attacks"] = value.pop('new_attacks', [])
             new_data[key] = value
         player['legends'] = new_data
-    return remove_id_fields(combined_data)
\ No newline at end of file
+    return TrustedJSONResponse(remove_id_fields(combined_data))
\ No newline at end of file
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+pytest.importorskip("motor")
+
+from utils.player_autocomplete import PlayerAutocomplete, normalize, prefix_end, SHORT_RANGE
+
+
+NAMES = ["a🔥", "🔥🔥", "🔥", "a", "ab", "abc", "a\U0010ffff", "\U0010ffff\U0010ffff", "𝓐𝓵𝓮𝔁", "b𐍈", "ｂ"]
+
+
+def build(names: list[str]) -> PlayerAutocomplete:
+    index = PlayerAutocomplete()
+    entries = [(normalize(name), i, {"name": name, "trophies": i}) for i, name in enumerate(names)]
+    # a build that never terminates fails the test instead of hanging it
+    thread = threading.Thread(target=index._build, args=(entries,), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "index build did not terminate"
+    return index
+
+
+def test_prefix_end_sorts_after_every_match():
+    for prefix in ["a", "🔥", "a🔥", "\U0010ffff", "a\U0010ffff"]:
+        end = prefix_end(prefix)
+        for name in NAMES:
+            if name.startswith(prefix) and end is not None:
+                assert name < end
+    assert prefix_end("\U0010ffff") is None
+
+
+def test_build_terminates_with_non_bmp_names():
+    build(NAMES)
+
+
+def test_build_terminates_with_large_non_bmp_ranges():
+    # ranges above SHORT_RANGE go through the precomputed top path
+    build([f"🔥{i}" for i in range(SHORT_RANGE + 5)] + [f"a🔥{i}" for i in range(SHORT_RANGE + 5)])
+
+
+def test_search_matches_non_bmp_names():
+    index = build(NAMES)
+    assert {d["name"] for d in index.search("🔥")} == {"🔥🔥", "🔥"}
+    assert {d["name"] for d in index.search("a🔥")} == {"a🔥"}
+    assert {d["name"] for d in index.search("a")} == {"a🔥", "a", "ab", "abc", "a\U0010ffff"}
+    assert {d["name"] for d in index.search("\U0010ffff")} == {"\U0010ffff\U0010ffff"}
+    assert {d["name"] for d in index.search("𝓐")} == {"𝓐𝓵𝓮𝔁"}
+
+
+def test_search_finds_overlay_changes_by_prefix():
+    index = build(NAMES)
+    index._apply({"operationType": "insert", "documentKey": {"_id": 100}, "fullDocument": {"name": "🔥new", "trophies": 500}})
+    index._apply({"operationType": "delete", "documentKey": {"_id": 1}})
+    assert [d["name"] for d in index.search("🔥")] == ["🔥new", "🔥"]
+    index._apply({"operationType": "replace", "documentKey": {"_id": 100}, "fullDocument": {"name": "zz", "trophies": 500}})
+    assert [d["name"] for d in index.search("🔥")] == ["🔥"]
+    assert [d["name"] for d in index.search("z")] == ["zz"]
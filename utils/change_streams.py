@@ -0,0 +1,60 @@
+"""
+Saved positions of the standalone change stream watchers (war_index, legend_seasons, clan_activity, cwl_standings).
+
+Each watcher keeps one document in change_stream_state with the resume token of the last change it processed, so
+a restart or reconnect carries on from there instead of from whatever happens after it reconnects. A token older
+than the oplog can't be resumed from anymore, it is dropped and the gap has to be filled by the backfill.
+"""
+import time
+
+from pymongo.errors import OperationFailure
+from utils.utils import db_client
+
+
+# ChangeStreamFatalError & ChangeStreamHistoryLost
+LOST_HISTORY_CODES = {280, 286}
+
+
+async def load_state(name: str) -> dict:
+    return await db_client.change_stream_state.find_one({"_id": name}) or {}
+
+
+def resume_options(state: dict) -> dict:
+    """Keyword arguments for watch() that pick up after the saved token, if there is one"""
+    if state.get("token") is not None:
+        return {"resume_after": state["token"]}
+    return {}
+
+
+async def save_state(name: str, **fields):
+    await db_client.change_stream_state.update_one({"_id": name}, {"$set": fields}, upsert=True)
+
+
+async def reset_token(name: str):
+    await db_client.change_stream_state.update_one({"_id": name}, {"$unset": {"token": ""}})
+
+
+def history_lost(error: Exception) -> bool:
+    return isinstance(error, OperationFailure) and error.code in LOST_HISTORY_CODES
+
+
+class Checkpoint:
+    """
+    Saves the resume token of the last processed change, at most once per `interval` seconds.
+
+    A restart replays whatever came after the last save, watchers whose writes aren't idempotent save with force=True
+    right after every write so that is only what they hadn't written yet.
+    """
+
+    def __init__(self, name: str, interval: float = 5):
+        self.name = name
+        self.interval = interval
+        self._saved = 0.0
+
+    async def __call__(self, token: dict | None, force: bool = False):
+        if token is None:
+            return
+        now = time.monotonic()
+        if force or now - self._saved >= self.interval:
+            await save_state(self.name, token=token)
+            self._saved = now
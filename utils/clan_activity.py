@@ -0,0 +1,158 @@
+"""
+Hourly & daily clan activity buckets built from player_history.
+
+Every (clan, granularity, bucket start) document holds the number of player_history events per type in that hour or
+day, so a time series over months is a range read of a few hundred small documents instead of thousands of raw events.
+The backfill recomputes whole days straight from player_history up to a cutoff (the start of the day it runs), the
+watcher keeps everything from the cutoff on current with $inc. The two never count the same event: the watcher skips
+events before the cutoff and drops what it hasn't written yet once a backfill moves the cutoff past it, and with no
+resume token it starts reading the stream at the cutoff.
+
+    python -m utils.clan_activity backfill [--days 90]
+    python -m utils.clan_activity watch
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from bson import Timestamp
+from collections import Counter, defaultdict
+from enum import Enum
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from utils import change_streams
+from utils.utils import db_client
+
+
+logger = logging.getLogger(__name__)
+
+WATCHER = "clan_activity"
+FLUSH_EVERY = 500
+
+
+class Granularity(str, Enum):
+    hour = "hour"
+    day = "day"
+
+
+BUCKET_SIZE = {Granularity.hour: 3600, Granularity.day: 86400}
+
+
+async def ensure_indexes():
+    await db_client.clan_activity.create_indexes([
+        IndexModel([("clan", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING)], unique=True),
+    ])
+
+
+async def get_series(clan_tag: str, granularity: Granularity, start: int, end: int) -> list[dict]:
+    size = BUCKET_SIZE[granularity]
+    return await db_client.clan_activity.find(
+        {"clan": clan_tag, "granularity": granularity.value, "bucket": {"$gte": start - start % size, "$lte": end}},
+        {"_id": 0, "bucket": 1, "total": 1, "counts": 1}
+    ).sort("bucket", 1).to_list(length=None)
+
+
+def _backfill_pipeline(granularity: Granularity, start: int, end: int) -> list[dict]:
+    size = BUCKET_SIZE[granularity]
+    return [
+        {"$match": {"time": {"$gte": start, "$lt": end}, "clan": {"$ne": None}, "type": {"$type": "string"}}},
+        {"$group": {"_id": {"clan": "$clan", "bucket": {"$subtract": ["$time", {"$mod": ["$time", size]}]}, "type": "$type"},
+                    "count": {"$sum": 1}}},
+        {"$group": {"_id": {"clan": "$_id.clan", "bucket": "$_id.bucket"},
+                    "counts": {"$push": {"k": "$_id.type", "v": "$count"}}, "total": {"$sum": "$count"}}},
+        {"$project": {"_id": 0, "clan": "$_id.clan", "granularity": granularity.value, "bucket": "$_id.bucket",
+                      "counts": {"$arrayToObject": "$counts"}, "total": 1}},
+        {"$merge": {"into": db_client.clan_activity.name, "on": ["clan", "granularity", "bucket"],
+                    "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+
+
+async def backfill(days: int = 90):
+    """
+    Recomputes the buckets of the `days` days before today one whole day at a time, so every bucket is replaced in
+    full. Today is left to the watcher, the cutoff is moved first so it stops writing to the days replaced here.
+    """
+    await ensure_indexes()
+    today = int(time.time()) // 86400 * 86400
+    await change_streams.save_state(WATCHER, cutoff=today)
+    for day_start in range(today - days * 86400, today, 86400):
+        for granularity in Granularity:
+            await db_client.player_history.aggregate(
+                _backfill_pipeline(granularity=granularity, start=day_start, end=day_start + 86400), allowDiskUse=True
+            ).to_list(length=None)
+        logger.info(f"bucketed {time.strftime('%Y-%m-%d', time.gmtime(day_start))}")
+
+
+async def _flush(pending: dict[tuple, Counter], cutoff: int) -> int:
+    """Writes the pending counts after the cutoff, returns the cutoff as the backfill last left it"""
+    if not pending:
+        return cutoff
+    cutoff = max(cutoff, (await change_streams.load_state(WATCHER)).get("cutoff", 0))
+    for key in [key for key in pending if key[2] < cutoff]:
+        del pending[key]
+    updates = []
+    for (clan, granularity, bucket), counts in pending.items():
+        inc = {f"counts.{event_type}": count for event_type, count in counts.items()}
+        inc["total"] = sum(counts.values())
+        updates.append(UpdateOne({"clan": clan, "granularity": granularity, "bucket": bucket}, {"$inc": inc}, upsert=True))
+    if updates:
+        await db_client.clan_activity.bulk_write(updates, ordered=False)
+    pending.clear()
+    return cutoff
+
+
+async def watch():
+    await ensure_indexes()
+    pipeline = [{"$match": {"operationType": "insert", "fullDocument.clan": {"$ne": None}}}]
+    pending = defaultdict(Counter)
+    # $inc isn't idempotent, the token is saved right after every write so a restart replays as little as possible
+    checkpoint = change_streams.Checkpoint(WATCHER)
+    history_lost = False
+    while True:
+        state = await change_streams.load_state(WATCHER)
+        cutoff = state.get("cutoff", 0)
+        options = change_streams.resume_options(state)
+        if not options and cutoff and not history_lost:
+            options = {"start_at_operation_time": Timestamp(cutoff, 0)}
+        pending.clear()
+        try:
+            async with db_client.player_history.watch(pipeline, **options) as stream:
+                while stream.alive:
+                    change = await stream.try_next()
+                    # try_next gives None once the stream is idle, that's when a partial batch gets written
+                    if change is None:
+                        wrote = bool(pending)
+                        cutoff = await _flush(pending, cutoff=cutoff)
+                        await checkpoint(stream.resume_token, force=wrote)
+                        continue
+                    event = change["fullDocument"]
+                    event_type, event_time = event.get("type"), event.get("time")
+                    if not isinstance(event_type, str) or not isinstance(event_time, (int, float)) or event_time < cutoff:
+                        continue
+                    for granularity, size in BUCKET_SIZE.items():
+                        bucket = int(event_time) - int(event_time) % size
+                        pending[(event["clan"], granularity.value, bucket)][event_type] += 1
+                    if len(pending) >= FLUSH_EVERY:
+                        cutoff = await _flush(pending, cutoff=cutoff)
+                        await checkpoint(stream.resume_token, force=True)
+        except Exception as e:
+            if change_streams.history_lost(e):
+                logger.error("resume point is older than the oplog, watching from now on, "
+                             "today's buckets miss the gap until the next backfill")
+                await change_streams.reset_token(WATCHER)
+                history_lost = True
+            else:
+                logger.exception("player history change stream failed, restarting")
+            await asyncio.sleep(5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the hourly & daily clan activity buckets")
+    parser.add_argument("command", choices=["backfill", "watch"])
+    parser.add_argument("--days", type=int, default=90, help="how many days back to backfill")
+    args = parser.parse_args()
+    if args.command == "backfill":
+        asyncio.run(backfill(days=args.days))
+    else:
+        asyncio.run(watch())
@@ -0,0 +1,60 @@
+"""
+Keyset pagination for /clan/search.
+
+A page is continued from the (sort field, _id) pair of the last clan on the previous page instead of an offset, and
+every sortable field has a compound index (optionally behind location.id, the most common equality filter), so a
+filtered browse in any order is an index scan no matter how deep it goes.
+
+    python -m utils.clan_search    (creates the indexes)
+"""
+import asyncio
+import orjson
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bson import ObjectId
+from enum import Enum
+from fastapi import HTTPException
+from pymongo import DESCENDING, IndexModel
+from utils.utils import db_client
+
+
+class ClanSortField(str, Enum):
+    clanPoints = "clanPoints"
+    level = "level"
+    members = "members"
+    warWins = "warWins"
+    warWinStreak = "warWinStreak"
+
+
+def encode_keyset(value, _id: ObjectId) -> str:
+    return urlsafe_b64encode(orjson.dumps([value, str(_id)])).decode()
+
+
+def decode_keyset(cursor: str, sort_by: ClanSortField | None) -> tuple:
+    """(value, _id) of a cursor, plain ObjectId strings are still accepted when sorting by _id"""
+    try:
+        if sort_by is None:
+            return None, ObjectId(cursor)
+        value, _id = orjson.loads(urlsafe_b64decode(cursor.encode()))
+        return value, ObjectId(_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(sort_by: ClanSortField | None, value, _id: ObjectId, op: str) -> dict:
+    """Everything strictly past (value, _id) in the direction of `op` ($gt or $lt)"""
+    if sort_by is None:
+        return {"_id": {op: _id}}
+    return {"$or": [{sort_by.value: {op: value}}, {sort_by.value: value, "_id": {op: _id}}]}
+
+
+async def ensure_indexes():
+    indexes = []
+    for field in ClanSortField:
+        indexes.append(IndexModel([(field.value, DESCENDING), ("_id", DESCENDING)]))
+        indexes.append(IndexModel([("location.id", DESCENDING), (field.value, DESCENDING), ("_id", DESCENDING)]))
+    await db_client.basic_clan.create_indexes(indexes)
+
+
+if __name__ == "__main__":
+    asyncio.run(ensure_indexes())
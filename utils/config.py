@@ -26,6 +26,8 @@ class Config:
     internal_api_token = getenv("INTERNAL_API_TOKEN")
 
     is_local = (getenv("LOCAL") == "TRUE")
+    player_search_index = (getenv("PLAYER_SEARCH_INDEX") == "TRUE")
+    player_names_index = (getenv("PLAYER_NAMES_INDEX") == "TRUE")
 
     client_secret = getenv("CLIENT_SECRET")
     bot_token = getenv("BOT_TOKEN")
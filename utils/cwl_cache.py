@@ -0,0 +1,75 @@
+"""
+Season scoped CWL cache shared by /cwl and /player/to-do.
+
+Groups are keyed by (clan, season) and wars by war tag. Once a group has ended or a war has reached warEnded the
+data can't change anymore, so those entries are kept without expiry, anything still live gets a short ttl. A miss is
+remembered per loader source, so a proxy hiccup can't hide a group that mongo has (or the other way around).
+"""
+import orjson
+
+from typing import Awaitable, Callable
+from utils.utils import redis, gen_games_season
+
+
+LIVE_TTL = 60
+
+GroupLoader = Callable[[], Awaitable[dict | None]]
+WarLoader = Callable[[list[str]], Awaitable[dict[str, dict]]]
+
+
+def group_key(clan_tag: str, season: str):
+    return f"cwl:group:{clan_tag}:{season}"
+
+
+def miss_key(source: str, clan_tag: str, season: str):
+    return f"cwl:group-miss:{source}:{clan_tag}:{season}"
+
+
+def war_key(war_tag: str):
+    return f"cwl:war:{war_tag}"
+
+
+async def get_group(clan_tag: str, season: str, loader: GroupLoader, source: str) -> dict | None:
+    cached, missed = await redis.mget([group_key(clan_tag, season), miss_key(source, clan_tag, season)])
+    if cached is not None:
+        return orjson.loads(cached) or None
+    if missed is not None:
+        return None
+
+    group = await loader()
+    if not group or group.get("season") != season:
+        # remember the miss for a moment, the clan may simply not be in cwl this season
+        await redis.set(miss_key(source, clan_tag, season), b"1", ex=LIVE_TTL)
+        return None
+
+    # groups stored in mongo don't always carry a state, but a group from a past season is done either way
+    finished = group.get("state") == "ended" or season < gen_games_season()
+    ttl = None if finished else LIVE_TTL
+    encoded = orjson.dumps(group)
+    pipe = redis.pipeline()
+    # every clan in the group gets the same document, so the other 7 clans never have to load it
+    for clan in group.get("clans", []):
+        pipe.set(group_key(clan.get("tag"), season), encoded, ex=ttl)
+    pipe.set(group_key(clan_tag, season), encoded, ex=ttl)
+    await pipe.execute()
+    return group
+
+
+async def get_wars(war_tags: list[str], loader: WarLoader) -> dict[str, dict]:
+    war_tags = [tag for tag in dict.fromkeys(war_tags) if tag != "#0"]
+    if not war_tags:
+        return {}
+    cached = await redis.mget([war_key(tag) for tag in war_tags])
+    wars = {tag: orjson.loads(data) for tag, data in zip(war_tags, cached) if data is not None}
+
+    missing = [tag for tag in war_tags if tag not in wars]
+    if missing:
+        loaded = await loader(missing)
+        pipe = redis.pipeline()
+        for tag, war in loaded.items():
+            if war is None:
+                continue
+            pipe.set(war_key(tag), orjson.dumps(war), ex=None if war.get("state") == "warEnded" else LIVE_TTL)
+            wars[tag] = war
+        await pipe.execute()
+    return wars
@@ -0,0 +1,197 @@
+"""
+Assembled CWL group standings, one document per (group, season).
+
+/cwl/{clan}/{season} stitches the group together with every round war and leaves the standings to the client. Here
+the rounds, a summary of every round war and the standings table are kept in cwl_standings, rebuilt whenever a round
+war ends and frozen once the season is over, so the standings route is a single read. A document that isn't frozen
+is rebuilt on read once it is older than STALE_AFTER, so a watcher that is down or behind only delays it a little.
+
+    python -m utils.cwl_standings backfill [--season YYYY-MM]
+    python -m utils.cwl_standings watch
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from pymongo import ASCENDING, IndexModel
+from utils import change_streams
+from utils.utils import db_client, gen_games_season
+from utils.war_log import war_summary
+
+
+logger = logging.getLogger(__name__)
+
+WATCHER = "cwl_standings"
+WIN_BONUS = 10
+STALE_AFTER = 60
+
+
+def group_id(group: dict) -> str:
+    """Groups have no id of their own, but the 8 clans in them are fixed for the season"""
+    return ",".join(sorted(clan.get("tag") for clan in group.get("clans", [])))
+
+
+def compute_standings(group: dict, wars: list[dict]) -> list[dict]:
+    """
+    Stars (with the win bonus), total destruction and the war record of every clan, ranked the way the game does,
+    by stars then destruction. Live wars count towards stars & destruction, the record only counts ended wars.
+    """
+    table = {clan.get("tag"): {"tag": clan.get("tag"), "name": clan.get("name"), "badgeUrls": clan.get("badgeUrls"),
+                               "stars": 0, "destruction": 0.0, "attacks": 0, "wins": 0, "losses": 0, "ties": 0}
+             for clan in group.get("clans", [])}
+    for war in wars:
+        if war.get("state") not in ("inWar", "warEnded"):
+            continue
+        team_size = war.get("teamSize", 0)
+        sides = (war.get("clan", {}), war.get("opponent", {}))
+        for us, them in (sides, sides[::-1]):
+            row = table.get(us.get("tag"))
+            if row is None:
+                continue
+            row["stars"] += us.get("stars", 0)
+            row["destruction"] += us.get("destructionPercentage", 0) * team_size
+            row["attacks"] += us.get("attacks", 0)
+            if war.get("state") != "warEnded":
+                continue
+            ours, theirs = (us.get("stars", 0), us.get("destructionPercentage", 0)), (them.get("stars", 0), them.get("destructionPercentage", 0))
+            if ours > theirs:
+                row["wins"] += 1
+                row["stars"] += WIN_BONUS
+            elif ours < theirs:
+                row["losses"] += 1
+            else:
+                row["ties"] += 1
+
+    standings = sorted(table.values(), key=lambda row: (row["stars"], row["destruction"]), reverse=True)
+    for rank, row in enumerate(standings, start=1):
+        row["rank"] = rank
+        row["destruction"] = round(row["destruction"], 2)
+    return standings
+
+
+def assemble(group: dict, season: str, wars: dict[str, dict]) -> dict:
+    rounds = []
+    for number, war_round in enumerate(group.get("rounds", []), start=1):
+        round_wars = [{"tag": tag} | war_summary(wars[tag]) if tag in wars else {"tag": tag} for tag in war_round.get("warTags", []) if tag != "#0"]
+        rounds.append({"round": number, "wars": round_wars})
+
+    round_tags = [tag for war_round in group.get("rounds", []) for tag in war_round.get("warTags", [])]
+    all_ended = bool(round_tags) and all(wars.get(tag, {}).get("state") == "warEnded" for tag in round_tags)
+    # past seasons are final even when a war never made it into clan_wars
+    frozen = (group.get("state") == "ended" and all_ended) or season < gen_games_season()
+    return {
+        "group": group_id(group),
+        "season": season,
+        "clans": sorted(clan.get("tag") for clan in group.get("clans", [])),
+        "state": group.get("state"),
+        "frozen": frozen,
+        "updated": int(time.time()),
+        "rounds": rounds,
+        "standings": compute_standings(group=group, wars=list(wars.values()))
+    }
+
+
+async def ensure_indexes():
+    await db_client.cwl_standings.create_indexes([
+        IndexModel([("group", ASCENDING), ("season", ASCENDING)], unique=True),
+        IndexModel([("clans", ASCENDING), ("season", ASCENDING)]),
+    ])
+
+
+async def refresh(clan_tag: str, season: str) -> dict | None:
+    """Rebuilds the standings of the group `clan_tag` is in, a frozen document is returned as is"""
+    group = await db_client.cwl_groups.find_one({"$and": [{"data.clans.tag": clan_tag}, {"data.season": season}]}, {"data": 1})
+    if group is None:
+        return None
+    group = group.get("data")
+    frozen = await db_client.cwl_standings.find_one({"group": group_id(group), "season": season, "frozen": True}, {"_id": 0})
+    if frozen is not None:
+        return frozen
+
+    war_tags = [tag for war_round in group.get("rounds", []) for tag in war_round.get("warTags", []) if tag != "#0"]
+    wars = await db_client.clan_wars.find({"$and": [{"data.tag": {"$in": war_tags}}, {"data.season": season}]}, {"data": 1}).to_list(length=None)
+    document = assemble(group=group, season=season, wars={w.get("data").get("tag"): w.get("data") for w in wars})
+    await db_client.cwl_standings.replace_one({"group": document["group"], "season": season}, document, upsert=True)
+    return document
+
+
+async def get_standings(clan_tag: str, season: str) -> dict | None:
+    standings = await db_client.cwl_standings.find_one({"clans": clan_tag, "season": season}, {"_id": 0})
+    # groups nobody has looked at since the watcher started are assembled on first read
+    if standings is None or (not standings.get("frozen") and time.time() - standings.get("updated", 0) > STALE_AFTER):
+        standings = await refresh(clan_tag=clan_tag, season=season)
+    return standings
+
+
+async def backfill(season: str = None):
+    await ensure_indexes()
+    query = {"data.season": season} if season else {}
+    count = 0
+    seen = set()
+    async for group in db_client.cwl_groups.find(query, {"data.season": 1, "data.clans.tag": 1}).batch_size(500):
+        data = group.get("data", {})
+        key = (group_id(data), data.get("season"))
+        if not data.get("clans") or key in seen:
+            continue
+        seen.add(key)
+        try:
+            await refresh(clan_tag=data["clans"][0].get("tag"), season=data.get("season"))
+        except Exception:
+            logger.exception(f"could not assemble group {key}")
+        count += 1
+        if count % 10_000 == 0:
+            logger.info(f"assembled {count} groups")
+    logger.info(f"backfill done, assembled {count} groups")
+
+
+async def watch():
+    """Rebuilds a group every time one of its round wars ends"""
+    await ensure_indexes()
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}, "fullDocument.data.state": "warEnded",
+                    "fullDocument.data.season": {"$exists": True}}},
+        {"$project": {"fullDocument.data.clan.tag": 1, "fullDocument.data.season": 1}}
+    ]
+    pending = set()
+    checkpoint = change_streams.Checkpoint(WATCHER)
+    while True:
+        state = await change_streams.load_state(WATCHER)
+        try:
+            async with db_client.clan_wars.watch(pipeline, full_document="updateLookup", **change_streams.resume_options(state)) as stream:
+                while stream.alive:
+                    change = await stream.try_next()
+                    if change is not None:
+                        war = change["fullDocument"]["data"]
+                        pending.add((war["clan"]["tag"], war["season"]))
+                        continue
+                    # the stream is idle, a round ends for a whole group at once so every group is rebuilt once
+                    done = set()
+                    for clan_tag, season in pending:
+                        if (clan_tag, season) in done:
+                            continue
+                        standings = await refresh(clan_tag=clan_tag, season=season)
+                        if standings is not None:
+                            done.update((tag, season) for tag in standings["clans"])
+                    pending.clear()
+                    # everything up to here is rebuilt, a restart picks up after it
+                    await checkpoint(stream.resume_token)
+        except Exception as e:
+            if change_streams.history_lost(e):
+                logger.error("resume token is older than the oplog, stale groups get rebuilt when they are read")
+                await change_streams.reset_token(WATCHER)
+            else:
+                logger.exception("clan war change stream failed, restarting")
+            await asyncio.sleep(5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the assembled cwl standings")
+    parser.add_argument("command", choices=["backfill", "watch"])
+    parser.add_argument("--season", default=None, help="only backfill groups of this season")
+    args = parser.parse_args()
+    if args.command == "backfill":
+        asyncio.run(backfill(season=args.season))
+    else:
+        asyncio.run(watch())
@@ -0,0 +1,48 @@
+import logging
+
+from fastapi.responses import Response
+from pydantic import BaseModel
+from utils.streaming import dumps
+
+
+logger = logging.getLogger(__name__)
+
+
+class TrustedJSONResponse(Response):
+    """
+    JSON response for data that comes straight from our own Mongo.
+
+    Returning a Response skips FastAPI's response_model validation and jsonable_encoder walk, the body is written by
+    orjson in one go. A route with a response_model keeps it for the OpenAPI schema and passes its rows through
+    conform_rows, so what goes out still matches that schema.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def model_projection(model: type[BaseModel]) -> dict:
+    """Projection of the stored field names of a model, so the fast path returns the same keys validation would"""
+    return {"_id": 0} | {(field.alias or name): 1 for name, field in model.model_fields.items()}
+
+
+def conform_rows(model: type[BaseModel], rows: list[dict]) -> list[dict]:
+    """
+    Rows shaped like model.model_dump(by_alias=True) without validating them: missing optional fields get their
+    default and rows missing a required field are dropped (validation would have failed the whole response).
+    """
+    defaults, required = {}, []
+    for name, field in model.model_fields.items():
+        if field.is_required():
+            required.append(field.alias or name)
+        else:
+            defaults[field.alias or name] = field.get_default(call_default_factory=True)
+    conformed = []
+    for row in rows:
+        missing = [key for key in required if row.get(key) is None]
+        if missing:
+            logger.warning(f"dropping a {model.__name__} row without {', '.join(missing)}")
+            continue
+        conformed.append(defaults | row if defaults else row)
+    return conformed
@@ -0,0 +1,98 @@
+from fastapi import HTTPException, Query
+
+
+MAX_FIELDS = 50
+
+
+class Fields:
+    """
+    A parsed ?fields=a,b.c sparse fieldset.
+
+    Dotted paths walk into nested objects and through lists, so `memberList.tag` keeps only the tag of every member.
+    The same set compiles into a Mongo projection (so the unused parts never leave the database) and filters the
+    response (for handlers that reshape documents before returning them). An empty set keeps everything.
+    """
+
+    def __init__(self, paths: list[str] = None):
+        # nested dict of the requested paths, None marks a path that is kept whole
+        self.tree: dict = {}
+        for path in paths or []:
+            node = self.tree
+            parts = path.split(".")
+            for i, part in enumerate(parts):
+                if i == len(parts) - 1:
+                    node[part] = None
+                elif part not in node:
+                    node[part] = {}
+                elif node[part] is None:
+                    break
+                node = node[part]
+
+    def __bool__(self):
+        return bool(self.tree)
+
+    def top_level(self) -> set[str]:
+        return set(self.tree)
+
+    def paths(self) -> list[str]:
+        paths = []
+
+        def walk(node: dict, prefix: str):
+            for key, child in node.items():
+                if child is None:
+                    paths.append(prefix + key)
+                else:
+                    walk(child, f"{prefix}{key}.")
+        walk(self.tree, "")
+        return paths
+
+    def projection(self, prefix: str = "", always: list[str] = (), sources: dict[str, list[str]] = None) -> dict | None:
+        """
+        Mongo projection for the requested fields, None when everything is wanted.
+
+        `prefix` is prepended to every path (e.g. "data." for wars), `always` lists stored fields the handler itself
+        needs and `sources` maps a response key to the stored fields it is built from when the two differ.
+        """
+        if not self:
+            return None
+        stored = list(always)
+        for path in self.paths():
+            top = path.split(".")[0]
+            if sources is not None and top in sources:
+                stored.extend(sources[top])
+            else:
+                stored.append(prefix + path)
+
+        projection = {"_id": 0}
+        # mongo rejects a path and one of its ancestors in the same projection
+        for path in sorted(set(stored), key=len):
+            if not any(path.startswith(kept + ".") for kept in projection):
+                projection[path] = 1
+        return projection
+
+    def filter(self, value):
+        if not self:
+            return value
+        return _pick(value, self.tree)
+
+
+def _pick(value, tree: dict | None):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [_pick(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: _pick(value[key], child) for key, child in tree.items() if key in value}
+    return value
+
+
+def fields_param(fields: str = Query(default=None, description="Comma separated fields to return, dotted paths select nested fields like memberList.tag")) -> Fields:
+    if not fields:
+        return Fields()
+    paths = [path.strip() for path in fields.split(",") if path.strip()]
+    if len(paths) > MAX_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Max {MAX_FIELDS} fields can be requested at one time")
+    for path in paths:
+        if any(not part or part.startswith("$") for part in path.split(".")):
+            raise HTTPException(status_code=400, detail=f"Invalid field: {path}")
+    return Fields(paths)
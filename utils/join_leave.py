@@ -0,0 +1,66 @@
+from collections import defaultdict
+
+
+def process_clan_events(events: list[dict]) -> list[dict]:
+    """
+    Processes and cleans a list of clan events by:
+    1. Pairing every 'join' with the first later 'leave' of the same player & clan and moving that leave to the
+       time of the next 'join' (or keeping its own time when there is none).
+    2. Sorting the events chronologically, prioritizing 'leave' events when times are equal.
+
+    Runs in one pass over the events plus the sort, the input list and its events are not modified.
+
+    Args:
+        events (list): A list of event dictionaries, oldest first. Each event should have at least the following keys:
+                       - 'type': 'join' or 'leave'
+                       - 'clan': Clan identifier
+                       - 'time': timestamp
+                       - 'tag': Player's tag
+
+    Returns:
+        list: A cleaned and sorted list of event dictionaries.
+    """
+    # positions of the leaves per (player, clan) and for each position the first join after it
+    leaves = defaultdict(list)
+    next_join = [None] * len(events)
+    upcoming = None
+    for i in range(len(events) - 1, -1, -1):
+        next_join[i] = upcoming
+        event = events[i]
+        if event.get("type") == "join":
+            upcoming = i
+        elif event.get("type") == "leave":
+            leaves[(event.get("tag"), event.get("clan"))].append(i)
+    for positions in leaves.values():
+        positions.reverse()
+    # per (player, clan), how far into its leaves the joins have got, leaves passed over can never be paired anymore
+    pointers = defaultdict(int)
+    consumed = set()
+
+    corrected_events = []
+    for i, event in enumerate(events):
+        if event.get("type") == "leave":
+            if i not in consumed:
+                corrected_events.append(event)
+            continue
+        if event.get("type") != "join":
+            continue
+
+        corrected_events.append(event)
+        key = (event.get("tag"), event.get("clan"))
+        positions = leaves.get(key)
+        if not positions:
+            continue
+        p = pointers[key]
+        while p < len(positions) and positions[p] < i:
+            p += 1
+        if p < len(positions):
+            leave_event = events[positions[p]]
+            consumed.add(positions[p])
+            p += 1
+            time = events[next_join[i]]["time"] if next_join[i] is not None else leave_event["time"]
+            corrected_events.append(leave_event | {"time": time})
+        pointers[key] = p
+
+    corrected_events.sort(key=lambda e: (e["time"], 0 if e["type"] == "leave" else 1))
+    return corrected_events
@@ -0,0 +1,183 @@
+"""
+Season bucketed legends history.
+
+player_stats keeps every legends day under legends.{YYYY-MM-DD}, so reading one day or one season meant loading a
+player's whole history. Here the days are mirrored into one document per (player, season) in legend_seasons, which
+the legends routes read from. A bucket is only trusted once it is complete, i.e. written by the backfill or filled
+in full from player_stats when the watcher created it, anything else is read from player_stats.
+player_stats stays the source of truth, the stats, bulk & legends routes still read their days from it.
+
+    python -m utils.legend_seasons backfill [--season YYYY-MM]
+    python -m utils.legend_seasons watch
+"""
+import argparse
+import asyncio
+import coc
+import logging
+import pendulum as pend
+import re
+
+from functools import lru_cache
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from utils import change_streams
+from utils.utils import db_client, gen_legend_date
+
+
+logger = logging.getLogger(__name__)
+
+DAY_KEY = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+WATCHER = "legend_seasons"
+
+
+@lru_cache(maxsize=256)
+def season_days(season: str) -> tuple[str, ...]:
+    """The legend days (YYYY-MM-DD) that make up a YYYY-MM season"""
+    year, month = map(int, season.split("-"))
+    previous_month = pend.date(year, month, 1).subtract(months=1)
+    season_start = pend.instance(coc.utils.get_season_start(month=previous_month.month, year=previous_month.year))
+    season_end = pend.instance(coc.utils.get_season_end(month=previous_month.month, year=previous_month.year))
+    return tuple(season_start.add(days=i).to_date_string() for i in range((season_end - season_start).days))
+
+
+@lru_cache(maxsize=4096)
+def day_season(day: str) -> str:
+    """The YYYY-MM season a legend day belongs to"""
+    date = pend.parse(day).date()
+    for candidate in (date, date.add(months=1), date.subtract(months=1)):
+        season = candidate.format("YYYY-MM")
+        if day in season_days(season):
+            return season
+    return date.format("YYYY-MM")
+
+
+def bucket_days(legends: dict) -> dict[str, dict]:
+    """season -> {days.YYYY-MM-DD: legends data} of the days in `legends`"""
+    by_season = {}
+    for day, value in legends.items():
+        if DAY_KEY.match(day) and isinstance(value, dict):
+            by_season.setdefault(day_season(day), {})[f"days.{day}"] = value
+    return by_season
+
+
+def bucket_updates(tag: str, legends: dict, complete: bool = False) -> list[UpdateOne]:
+    """
+    One upsert per season, in the order of bucket_days. `complete` marks the buckets as holding every day of their
+    season, so it is only for writes of whole seasons.
+    """
+    return [UpdateOne({"tag": tag, "season": season}, {"$set": days | ({"complete": True} if complete else {})}, upsert=True)
+            for season, days in bucket_days(legends).items()]
+
+
+async def ensure_indexes():
+    await db_client.legend_seasons.create_indexes([
+        IndexModel([("tag", ASCENDING), ("season", ASCENDING)], unique=True),
+        IndexModel([("season", ASCENDING)]),
+    ])
+
+
+async def get_days(tags: list[str], season: str) -> dict[str, dict]:
+    """tag -> {day: legends data} for a season, read from the buckets with player_stats as fallback"""
+    buckets = await db_client.legend_seasons.find({"tag": {"$in": tags}, "season": season},
+                                                  {"_id": 0, "tag": 1, "days": 1, "complete": 1}).to_list(length=None)
+    result = {b["tag"]: b.get("days", {}) for b in buckets if b.get("complete")}
+    partial = {b["tag"]: b.get("days", {}) for b in buckets if not b.get("complete")}
+    missing = [tag for tag in tags if tag not in result]
+    if missing:
+        days = season_days(season)
+        projection = {"_id": 0, "tag": 1} | {f"legends.{day}": 1 for day in days}
+        async for stats in db_client.player_stats_db.find({"tag": {"$in": missing}}, projection):
+            result[stats["tag"]] = stats.get("legends", {}) | partial.get(stats["tag"], {})
+    return result
+
+
+async def get_day(tags: list[str], day: str) -> dict[str, dict]:
+    """tag -> legends data of a single day"""
+    buckets = await db_client.legend_seasons.find({"tag": {"$in": tags}, "season": day_season(day)},
+                                                  {"_id": 0, "tag": 1, f"days.{day}": 1, "complete": 1}).to_list(length=None)
+    result = {b["tag"]: b.get("days", {}).get(day, {}) for b in buckets if b.get("complete") or b.get("days", {}).get(day)}
+    missing = [tag for tag in tags if tag not in result]
+    if missing:
+        async for stats in db_client.player_stats_db.find({"tag": {"$in": missing}}, {"_id": 0, "tag": 1, f"legends.{day}": 1}):
+            result[stats["tag"]] = stats.get("legends", {}).get(day, {})
+    return result
+
+
+async def backfill(season: str = None):
+    await ensure_indexes()
+    projection = {"tag": 1, "legends": 1}
+    if season:
+        projection = {"tag": 1} | {f"legends.{day}": 1 for day in season_days(season)}
+    count = 0
+    updates = []
+    async for stats in db_client.player_stats_db.find({"legends": {"$exists": True}}, projection).batch_size(500):
+        updates.extend(bucket_updates(tag=stats.get("tag"), legends=stats.get("legends") or {}, complete=True))
+        count += 1
+        if len(updates) >= 1000:
+            await db_client.legend_seasons.bulk_write(updates, ordered=False)
+            updates = []
+        if count % 50_000 == 0:
+            logger.info(f"bucketed {count} players")
+    if updates:
+        await db_client.legend_seasons.bulk_write(updates, ordered=False)
+    logger.info(f"backfill done, bucketed {count} players")
+
+
+async def _fill(tag: str, season: str):
+    """Copies a whole season from player_stats into a bucket the watcher just created, which makes it complete"""
+    projection = {"tag": 1} | {f"legends.{day}": 1 for day in season_days(season)}
+    stats = await db_client.player_stats_db.find_one({"tag": tag}, projection)
+    if stats is not None:
+        await db_client.legend_seasons.bulk_write(bucket_updates(tag=tag, legends=stats.get("legends") or {}, complete=True), ordered=False)
+
+
+async def watch():
+    """Dual write, mirrors every legends day the tracker updates in player_stats into its season bucket"""
+    await ensure_indexes()
+    pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "insert"]}}}]
+    # the writes are $sets of the current value, replaying a few changes after a restart is harmless
+    checkpoint = change_streams.Checkpoint(WATCHER)
+    while True:
+        state = await change_streams.load_state(WATCHER)
+        try:
+            async with db_client.player_stats_db.watch(pipeline, **change_streams.resume_options(state)) as stream:
+                async for change in stream:
+                    if change["operationType"] == "update":
+                        fields = list(change["updateDescription"]["updatedFields"])
+                        days = {f.split(".")[1] for f in fields if f.startswith("legends.") and DAY_KEY.match(f.split(".")[1])}
+                        if "legends" in fields:
+                            days.add("*")
+                    else:
+                        days = {"*"}
+                    if days:
+                        projection = {"tag": 1, "legends": 1} if "*" in days else {"tag": 1} | {f"legends.{day}": 1 for day in days}
+                        stats = await db_client.player_stats_db.find_one({"_id": change["documentKey"]["_id"]}, projection)
+                        legends = (stats or {}).get("legends") or {}
+                        updates = bucket_updates(tag=stats.get("tag"), legends=legends) if stats is not None else []
+                        if updates:
+                            result = await db_client.legend_seasons.bulk_write(updates, ordered=False)
+                            seasons = list(bucket_days(legends))
+                            for index in result.upserted_ids:
+                                await _fill(tag=stats.get("tag"), season=seasons[index])
+                    await checkpoint(change["_id"])
+        except Exception as e:
+            if change_streams.history_lost(e):
+                # days were missed, the current buckets can't be trusted until the next backfill
+                season = day_season(gen_legend_date())
+                logger.error(f"resume token is older than the oplog, {season} buckets are marked incomplete until a backfill")
+                await db_client.legend_seasons.update_many({"season": season}, {"$unset": {"complete": ""}})
+                await change_streams.reset_token(WATCHER)
+            else:
+                logger.exception("player stats change stream failed, restarting")
+            await asyncio.sleep(5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the season bucketed legends history")
+    parser.add_argument("command", choices=["backfill", "watch"])
+    parser.add_argument("--season", default=None, help="only backfill this YYYY-MM season")
+    args = parser.parse_args()
+    if args.command == "backfill":
+        asyncio.run(backfill(season=args.season))
+    else:
+        asyncio.run(watch())
@@ -0,0 +1,179 @@
+import asyncio
+import heapq
+import logging
+
+from bisect import bisect_left, insort
+from utils.utils import config, db_client
+
+
+logger = logging.getLogger(__name__)
+
+# prefixes up to this length match too much of the array to rank per request, their top results are kept ready
+SHORT_PREFIX = 3
+SHORT_RANGE = 1000
+TOP_KEPT = 50
+# changes are served from a small overlay and folded into the arrays once it grows this large
+COMPACT_AFTER = 20_000
+
+
+def normalize(name: str) -> str:
+    return " ".join(name.casefold().split())
+
+
+def prefix_end(prefix: str) -> str | None:
+    """The smallest string that sorts after every string starting with `prefix`, None if there is none"""
+    prefix = prefix.rstrip("\U0010ffff")
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def prefix_range(keys: list, prefix: str, lo: int = 0) -> tuple[int, int]:
+    start = bisect_left(keys, prefix, lo=lo)
+    end = prefix_end(prefix)
+    return start, len(keys) if end is None else bisect_left(keys, end, lo=start)
+
+
+def popularity(doc: dict) -> int:
+    # player_search has no hit counter of its own, trophies are the best proxy for how often a name is looked up
+    return doc.get("trophies") or 0
+
+
+class PlayerAutocomplete:
+    """
+    Prefix index over player_search for /player/search, a local stand-in for the Atlas autocomplete index.
+
+    Names are normalized and kept in one sorted array with the documents and popularity in parallel arrays, so a
+    prefix is a pair of bisects and the matches are ranked by popularity. The array is built from a snapshot on
+    startup, changes from the change stream go into an overlay that is merged into the array in the background.
+
+    The arrays hold the whole collection, so only processes started with PLAYER_SEARCH_INDEX=TRUE build them, every
+    other worker keeps using the Atlas search index.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self._task: asyncio.Task | None = None
+        # (sorted keys, ids, docs, popularity, top matches of the short prefixes)
+        self._index: tuple = ([], [], [], [], {})
+        # _id -> (key, doc) for upserts, None for deletes
+        self._overlay: dict = {}
+        # sorted (key, _id) of the overlay upserts, so the overlay is searched by prefix as well
+        self._overlay_keys: list = []
+        self._compacting: asyncio.Task | None = None
+
+    async def start(self):
+        if not config.player_search_index:
+            return
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def load(self):
+        self.ready = False
+        entries = []
+        async for doc in db_client.player_search.find({}).batch_size(5000):
+            _id = doc.pop("_id")
+            if doc.get("name"):
+                entries.append((normalize(doc["name"]), _id, doc))
+        self._overlay = {}
+        self._overlay_keys = []
+        await asyncio.to_thread(self._build, entries)
+        self.ready = True
+        logger.info(f"player autocomplete built with {len(self._index[0])} names")
+
+    def _build(self, entries: list[tuple]):
+        entries.sort(key=lambda e: e[0])
+        keys = [e[0] for e in entries]
+        pops = [popularity(e[2]) for e in entries]
+
+        top = {}
+        for length in range(1, SHORT_PREFIX + 1):
+            start = 0
+            while start < len(keys):
+                prefix = keys[start][:length]
+                if len(prefix) < length:
+                    start += 1
+                    continue
+                _, end = prefix_range(keys, prefix, lo=start)
+                if end - start > SHORT_RANGE:
+                    top[prefix] = heapq.nlargest(TOP_KEPT, range(start, end), key=pops.__getitem__)
+                # keys[start] itself starts with prefix, so end is always past it
+                start = max(end, start + 1)
+
+        # swapped in one assignment so a search never sees half of an old and half of a new index
+        self._index = (keys, [e[1] for e in entries], [e[2] for e in entries], pops, top)
+
+    def search(self, name: str, limit: int = 25) -> list[dict]:
+        query = normalize(name)
+        if not query:
+            return []
+        keys, ids, docs, pops, top = self._index
+        candidates = top.get(query)
+        if candidates is None:
+            candidates = range(*prefix_range(keys, query))
+
+        overlay = self._overlay
+        ranked = [(pops[i], docs[i]) for i in candidates if ids[i] not in overlay]
+        overlay_keys = self._overlay_keys
+        start = bisect_left(overlay_keys, (query,))
+        end = prefix_end(query)
+        end = len(overlay_keys) if end is None else bisect_left(overlay_keys, (end,), lo=start)
+        for _, _id in overlay_keys[start:end]:
+            document = overlay[_id][1]
+            ranked.append((popularity(document), document))
+        return [doc for _, doc in heapq.nlargest(limit, ranked, key=lambda r: r[0])]
+
+    def _set_overlay(self, _id, change: tuple | None):
+        previous = self._overlay.get(_id)
+        if previous is not None:
+            index = bisect_left(self._overlay_keys, (previous[0], _id))
+            del self._overlay_keys[index]
+        self._overlay[_id] = change
+        if change is not None:
+            insort(self._overlay_keys, (change[0], _id))
+
+    def _apply(self, change: dict):
+        _id = change["documentKey"]["_id"]
+        document = change.get("fullDocument")
+        if change["operationType"] == "delete" or document is None or not document.get("name"):
+            self._set_overlay(_id, None)
+        else:
+            document.pop("_id", None)
+            self._set_overlay(_id, (normalize(document["name"]), document))
+        if len(self._overlay) >= COMPACT_AFTER and (self._compacting is None or self._compacting.done()):
+            self._compacting = asyncio.create_task(self._compact())
+
+    async def _compact(self):
+        overlay = dict(self._overlay)
+        keys, ids, docs, _, _ = self._index
+        entries = [(key, _id, doc) for key, _id, doc in zip(keys, ids, docs) if _id not in overlay]
+        entries.extend((change[0], _id, change[1]) for _id, change in overlay.items() if change is not None)
+        await asyncio.to_thread(self._build, entries)
+        # keep whatever arrived while the arrays were rebuilt
+        for _id, change in overlay.items():
+            if self._overlay.get(_id, 0) is change:
+                del self._overlay[_id]
+        self._overlay_keys = sorted((change[0], _id) for _id, change in self._overlay.items() if change is not None)
+
+    async def _watch(self):
+        while True:
+            try:
+                async with db_client.player_search.watch(full_document="updateLookup") as stream:
+                    await self.load()
+                    async for change in stream:
+                        if change["operationType"] in {"drop", "rename", "invalidate"}:
+                            break
+                        self._apply(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("player search change stream failed, restarting")
+                self.ready = False
+                await asyncio.sleep(5)
+
+
+player_autocomplete = PlayerAutocomplete()
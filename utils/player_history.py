@@ -0,0 +1,42 @@
+"""
+Indexed reads of a player's player_history events.
+
+/player/{tag}/historical/{season} streams the season grouped by event type. A (tag, type, time) index hands the events
+over in that order without a blocking sort, and the cap keeps the earliest events of the season: the time of the
+last event that fits is looked up first on the (tag, time) index, and only events up to it are read.
+
+    python -m utils.player_history    (creates the indexes)
+"""
+import asyncio
+
+from pymongo import ASCENDING, IndexModel
+from utils.utils import db_client
+
+
+MAX_SEASON_EVENTS = 25000
+
+
+async def last_kept_time(player_tag: str, start: float, end: float, cap: int = MAX_SEASON_EVENTS) -> float:
+    """Time of the `cap`-th event of the player between start & end, or end when there are fewer"""
+    last = await db_client.player_history.find(
+        {"tag": player_tag, "time": {"$gte": start, "$lte": end}}, {"_id": 0, "time": 1}
+    ).sort("time", 1).skip(cap - 1).limit(1).to_list(length=1)
+    return last[0]["time"] if last else end
+
+
+def season_events(player_tag: str, start: float, end: float, cap: int = MAX_SEASON_EVENTS):
+    """Cursor over the events between start & end, sorted by type then time"""
+    return db_client.player_history.find(
+        {"tag": player_tag, "time": {"$gte": start, "$lte": end}}, {"_id": 0}
+    ).sort({"type": 1, "time": 1}).limit(cap)
+
+
+async def ensure_indexes():
+    await db_client.player_history.create_indexes([
+        IndexModel([("tag", ASCENDING), ("time", ASCENDING)]),
+        IndexModel([("tag", ASCENDING), ("type", ASCENDING), ("time", ASCENDING)]),
+    ])
+
+
+if __name__ == "__main__":
+    asyncio.run(ensure_indexes())
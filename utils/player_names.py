@@ -0,0 +1,173 @@
+import asyncio
+import logging
+
+from array import array
+from utils.utils import config, db_client
+
+
+logger = logging.getLogger(__name__)
+
+NUMERIC_FIELDS = ("townhall", "expLevel", "trophies", "donations")
+# slots a single search may look at, so short names with rare filters can't walk the whole index
+MAX_SCAN = 50_000
+
+
+def trigrams(name: str) -> set[str]:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class PlayerNameIndex:
+    """
+    Trigram index over the names of every member of every tracked clan.
+
+    Each member gets a slot, the numeric filters live in flat arrays indexed by that slot and every trigram of the
+    casefolded name maps to the set of slots containing it. A search walks the smallest posting set and checks the
+    substring + filters per slot, so no regex is ever run on user input. Built in the background on startup (when
+    PLAYER_NAMES_INDEX is set) and kept current from a change stream on basic_clan.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self._task: asyncio.Task | None = None
+        self._reset()
+
+    def _reset(self):
+        self._members: list[dict | None] = []
+        self._names: list[str | None] = []
+        self._clans: list[tuple[str, str] | None] = []
+        self._columns = {field: array("i") for field in NUMERIC_FIELDS}
+        self._free: list[int] = []
+        self._postings: dict[str, set[int]] = {}
+        # clan _id -> {member tag: slot}
+        self._by_clan: dict = {}
+
+    async def start(self):
+        if not config.player_names_index:
+            return
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def load(self):
+        self.ready = False
+        self._reset()
+        count = 0
+        async for clan in db_client.basic_clan.find({}, {"tag": 1, "name": 1, "memberList": 1}).batch_size(1000):
+            self._set_clan(clan)
+            count += 1
+        self.ready = True
+        logger.info(f"player name index built from {count} clans, {len(self._members) - len(self._free)} members")
+
+    def search(self, name: str, limit: int, role: str = None, league: str = None,
+               ranges: dict[str, tuple[int, int]] = None) -> list[dict]:
+        query = name.casefold()
+        ranges = ranges or {}
+        grams = trigrams(query)
+        if grams:
+            candidates = min((self._postings.get(gram, ()) for gram in grams), key=len)
+        else:
+            # 1 or 2 characters, nothing to narrow on but the limit stops the scan early for anything common
+            candidates = range(len(self._names))
+
+        items = []
+        for scanned, slot in enumerate(candidates):
+            if scanned == MAX_SCAN:
+                break
+            lowered = self._names[slot]
+            if lowered is None or query not in lowered:
+                continue
+            member = self._members[slot]
+            if role is not None and member.get("role") != role:
+                continue
+            if league is not None and member.get("league") != league:
+                continue
+            if any(not (low <= self._columns[field][slot] <= high) for field, (low, high) in ranges.items()):
+                continue
+            clan_tag, clan_name = self._clans[slot]
+            items.append(member | {"clan_name": clan_name, "clan_tag": clan_tag})
+            if len(items) >= limit:
+                break
+        return items
+
+    def _add(self, member: dict, clan: tuple[str, str]) -> int:
+        lowered = member.get("name", "").casefold()
+        if self._free:
+            slot = self._free.pop()
+            self._members[slot], self._names[slot], self._clans[slot] = member, lowered, clan
+            for field in NUMERIC_FIELDS:
+                self._columns[field][slot] = member.get(field) or 0
+        else:
+            slot = len(self._members)
+            self._members.append(member)
+            self._names.append(lowered)
+            self._clans.append(clan)
+            for field in NUMERIC_FIELDS:
+                self._columns[field].append(member.get(field) or 0)
+        for gram in trigrams(lowered):
+            self._postings.setdefault(gram, set()).add(slot)
+        return slot
+
+    def _remove(self, slot: int):
+        for gram in trigrams(self._names[slot]):
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(slot)
+                if not posting:
+                    del self._postings[gram]
+        self._members[slot] = self._names[slot] = self._clans[slot] = None
+        self._free.append(slot)
+
+    def _set_clan(self, clan: dict):
+        previous = self._by_clan.pop(clan["_id"], {})
+        info = (clan.get("tag"), clan.get("name"))
+        slots = {}
+        for member in clan.get("memberList") or []:
+            tag = member.get("tag")
+            slot = previous.pop(tag, None)
+            if slot is not None and self._names[slot] == member.get("name", "").casefold():
+                # same name, only the stats moved, so the postings can stay as they are
+                self._members[slot], self._clans[slot] = member, info
+                for field in NUMERIC_FIELDS:
+                    self._columns[field][slot] = member.get(field) or 0
+            else:
+                if slot is not None:
+                    self._remove(slot)
+                slot = self._add(member, info)
+            slots[tag] = slot
+        for slot in previous.values():
+            self._remove(slot)
+        if slots:
+            self._by_clan[clan["_id"]] = slots
+
+    def _drop_clan(self, _id):
+        for slot in self._by_clan.pop(_id, {}).values():
+            self._remove(slot)
+
+    async def _watch(self):
+        while True:
+            try:
+                pipeline = [{"$project": {"operationType": 1, "documentKey": 1, "fullDocument._id": 1, "fullDocument.tag": 1,
+                                          "fullDocument.name": 1, "fullDocument.memberList": 1}}]
+                async with db_client.basic_clan.watch(pipeline, full_document="updateLookup") as stream:
+                    # (re)build after the stream is open so nothing that happens during the load is lost
+                    await self.load()
+                    async for change in stream:
+                        if change["operationType"] in {"drop", "rename", "invalidate"}:
+                            break
+                        document = change.get("fullDocument")
+                        if change["operationType"] == "delete" or document is None:
+                            self._drop_clan(change["documentKey"]["_id"])
+                        else:
+                            self._set_clan(document)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("player name index change stream failed, restarting")
+                self.ready = False
+                await asyncio.sleep(5)
+
+
+player_names = PlayerNameIndex()
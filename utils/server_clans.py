@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import orjson
+
+from collections import defaultdict
+from utils.utils import db_client, redis
+
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY = "server_clans"
+
+
+class ServerClanCache:
+    """
+    Discord server -> family clans, kept in process and mirrored to redis.
+
+    The whole mapping is loaded eagerly on startup and then kept current from a change stream
+    on usafam.clans, so resolving a family costs a dict lookup instead of a Mongo round-trip.
+    """
+
+    def __init__(self):
+        self._by_server: dict[int, dict[str, str]] = defaultdict(dict)
+        self._by_id: dict = {}
+        self._loaded = False
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        try:
+            await self.load()
+        except Exception:
+            logger.exception("could not load server clans, falling back to per request lookups")
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def load(self):
+        by_server = defaultdict(dict)
+        by_id = {}
+        async for clan in db_client.clans_db.find({}, {"server": 1, "tag": 1, "name": 1}):
+            server, tag = clan.get("server"), clan.get("tag")
+            by_id[clan["_id"]] = (server, tag)
+            by_server[server][tag] = clan.get("name")
+        self._by_server = by_server
+        self._by_id = by_id
+        self._loaded = True
+
+        pipe = redis.pipeline()
+        pipe.delete(REDIS_KEY)
+        for server in by_server:
+            pipe.hset(REDIS_KEY, str(server), self._dump(server))
+        await pipe.execute()
+
+    async def get_tags(self, server: int) -> list[str]:
+        return [c["tag"] for c in await self.get_clans(server=server)]
+
+    async def get_clans(self, server: int) -> list[dict]:
+        if self._loaded:
+            return [{"tag": tag, "name": name} for tag, name in self._by_server.get(server, {}).items()]
+
+        # not warmed up yet (or the startup load failed), try the shared copy before hitting Mongo
+        cached = await redis.hget(REDIS_KEY, str(server))
+        if cached is not None:
+            return orjson.loads(cached)
+        clans = await db_client.clans_db.find({"server": server}, {"_id": 0, "tag": 1, "name": 1}).to_list(length=None)
+        return [{"tag": c.get("tag"), "name": c.get("name")} for c in clans]
+
+    def _dump(self, server: int) -> bytes:
+        return orjson.dumps([{"tag": tag, "name": name} for tag, name in self._by_server.get(server, {}).items()])
+
+    def _apply(self, change: dict) -> set:
+        """Apply a single change event in memory, returns the servers whose clan list changed"""
+        _id = change["documentKey"]["_id"]
+        touched = set()
+        previous = self._by_id.pop(_id, None)
+        if previous is not None:
+            server, tag = previous
+            self._by_server[server].pop(tag, None)
+            touched.add(server)
+
+        document = change.get("fullDocument")
+        if change["operationType"] != "delete" and document is not None:
+            server, tag = document.get("server"), document.get("tag")
+            self._by_id[_id] = (server, tag)
+            self._by_server[server][tag] = document.get("name")
+            touched.add(server)
+        return touched
+
+    async def _watch(self):
+        reload = not self._loaded
+        while True:
+            try:
+                async with db_client.clans_db.watch(full_document="updateLookup") as stream:
+                    # anything that changed while the stream was down would otherwise be missed
+                    if reload:
+                        await self.load()
+                        reload = False
+                    async for change in stream:
+                        if change["operationType"] in {"drop", "rename", "invalidate"}:
+                            break
+                        touched = self._apply(change)
+                        if touched:
+                            pipe = redis.pipeline()
+                            for server in touched:
+                                if self._by_server.get(server):
+                                    pipe.hset(REDIS_KEY, str(server), self._dump(server))
+                                else:
+                                    self._by_server.pop(server, None)
+                                    pipe.hdel(REDIS_KEY, str(server))
+                            await pipe.execute()
+                reload = True
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("server clan change stream failed, restarting")
+                reload = True
+                await asyncio.sleep(5)
+
+
+server_clans = ServerClanCache()
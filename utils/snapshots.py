@@ -0,0 +1,92 @@
+import hashlib
+import orjson
+import re
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from fastapi import HTTPException
+from utils.utils import redis
+
+
+SNAPSHOT_TTL = 300
+
+
+def snapshot_key(name: str, params: dict) -> str:
+    digest = hashlib.sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return f"stats_snapshot:{name}:{digest}"
+
+
+def _key_pattern(name: str) -> re.Pattern:
+    return re.compile(rf"stats_snapshot:{re.escape(name)}:[0-9a-f]{{40}}")
+
+
+def encode_cursor(key: str, offset: int) -> str:
+    return urlsafe_b64encode(orjson.dumps({"k": key, "o": offset})).decode()
+
+
+def decode_cursor(name: str, cursor: str) -> tuple[str, int]:
+    """The snapshot key & offset of a cursor, only cursors this endpoint handed out itself are accepted"""
+    try:
+        data = orjson.loads(urlsafe_b64decode(cursor.encode()))
+        key, offset = data["k"], int(data["o"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(key, str) or not _key_pattern(name).fullmatch(key) or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key, offset
+
+
+async def _page(key: str, offset: int, limit: int):
+    pipe = redis.pipeline()
+    pipe.lrange(f"{key}:items", offset, offset + limit - 1)
+    pipe.llen(f"{key}:items")
+    items, total = await pipe.execute()
+    next_cursor = encode_cursor(key, offset + limit) if offset + limit < total else None
+    return [orjson.loads(item) for item in items], next_cursor
+
+
+async def snapshot_first_page(name: str, params: dict, limit: int):
+    """
+    First page of an existing snapshot for this exact query, or None if it has to be computed.
+    Totals and clan totals are only ever sent with the first page.
+    """
+    key = snapshot_key(name, params)
+    header = await redis.get(f"{key}:header")
+    if header is None:
+        return None
+    items, next_cursor = await _page(key=key, offset=0, limit=limit)
+    return orjson.loads(header) | {"items": items, "next_cursor": next_cursor}
+
+
+async def keep_snapshot(name: str, cursor: str):
+    """Restarts the ttl of the snapshot behind a cursor, for readers walking all of it, 410 if it is already gone"""
+    key, _ = decode_cursor(name=name, cursor=cursor)
+    pipe = redis.pipeline()
+    pipe.expire(f"{key}:header", SNAPSHOT_TTL)
+    pipe.expire(f"{key}:items", SNAPSHOT_TTL)
+    if not all(await pipe.execute()):
+        raise HTTPException(status_code=410, detail="Snapshot expired, request the first page again")
+
+
+async def snapshot_cursor_page(name: str, cursor: str, limit: int):
+    key, offset = decode_cursor(name=name, cursor=cursor)
+    header = await redis.get(f"{key}:header")
+    if header is None:
+        raise HTTPException(status_code=410, detail="Cursor expired, request the first page again")
+    items, next_cursor = await _page(key=key, offset=offset, limit=limit)
+    return {"items": items, "metadata": orjson.loads(header).get("metadata"), "next_cursor": next_cursor}
+
+
+async def store_snapshot(name: str, params: dict, items: list, totals: dict, clan_totals: list, metadata: dict, limit: int):
+    """Store a fully ranked leaderboard and return its first page"""
+    key = snapshot_key(name, params)
+    header = {"totals": totals, "clan_totals": clan_totals, "metadata": metadata}
+    pipe = redis.pipeline()
+    pipe.delete(f"{key}:items")
+    if items:
+        pipe.rpush(f"{key}:items", *[orjson.dumps(item) for item in items])
+        pipe.expire(f"{key}:items", SNAPSHOT_TTL)
+    pipe.set(f"{key}:header", orjson.dumps(header), ex=SNAPSHOT_TTL)
+    await pipe.execute()
+
+    next_cursor = encode_cursor(key, limit) if limit < len(items) else None
+    return {"items": items[:limit]} | header | {"next_cursor": next_cursor}
@@ -0,0 +1,141 @@
+import orjson
+
+from bson import ObjectId
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+from typing import AsyncIterable, Callable
+
+
+FLUSH_SIZE = 64 * 1024
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def wants_ndjson(request: Request) -> bool:
+    return request.query_params.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("accept", "")
+
+
+class JSONStreamResponse(StreamingResponse):
+    """
+    Serializes documents from an async cursor as they arrive instead of building the whole list first.
+
+    By default the documents are written as a JSON array, optionally wrapped in an object under `wrap` (with extra
+    keys from `trailer()` added after the array, once everything has been seen). With `group_by` the output is an
+    object of arrays keyed by that field, which expects the cursor to be sorted on it.
+    If the client asks for NDJSON (?format=ndjson or Accept: application/x-ndjson) every document is a line instead,
+    and the `trailer()` object, if there is one, is the last line.
+    """
+
+    def __init__(self, docs: AsyncIterable[dict], request: Request = None, transform: Callable[[dict], dict] = None,
+                 wrap: str = None, group_by: str = None, trailer: Callable[[], dict] = None, **kwargs):
+        self.docs = docs
+        self.transform = transform or (lambda doc: doc)
+        if request is not None and wants_ndjson(request):
+            content, media_type = self._ndjson(trailer), "application/x-ndjson"
+        elif group_by is not None:
+            content, media_type = self._grouped(group_by), "application/json"
+        else:
+            content, media_type = self._array(wrap, trailer), "application/json"
+        super().__init__(content, media_type=media_type, **kwargs)
+
+    async def _close(self):
+        close = getattr(self.docs, "close", None)
+        if close is not None:
+            await close()
+
+    async def _ndjson(self, trailer: Callable[[], dict] = None):
+        buffer = bytearray()
+        try:
+            async for doc in self.docs:
+                buffer += dumps(self.transform(doc))
+                buffer += b"\n"
+                if len(buffer) >= FLUSH_SIZE:
+                    yield bytes(buffer)
+                    buffer.clear()
+        finally:
+            await self._close()
+        if trailer is not None:
+            buffer += dumps(trailer())
+            buffer += b"\n"
+        yield bytes(buffer)
+
+    async def _array(self, wrap: str = None, trailer: Callable[[], dict] = None):
+        buffer = bytearray(b'{' + dumps(wrap) + b':[' if wrap is not None else b'[')
+        first = True
+        try:
+            async for doc in self.docs:
+                if not first:
+                    buffer += b","
+                first = False
+                buffer += dumps(self.transform(doc))
+                if len(buffer) >= FLUSH_SIZE:
+                    yield bytes(buffer)
+                    buffer.clear()
+        finally:
+            await self._close()
+        buffer += b"]"
+        if wrap is not None:
+            for key, value in (trailer() if trailer is not None else {}).items():
+                buffer += b"," + dumps(key) + b":" + dumps(value)
+            buffer += b"}"
+        yield bytes(buffer)
+
+    async def _grouped(self, group_by: str):
+        buffer = bytearray(b"{")
+        current = _missing = object()
+        try:
+            async for doc in self.docs:
+                key = doc.get(group_by)
+                if key != current:
+                    if current is not _missing:
+                        buffer += b"],"
+                    buffer += dumps(str(key)) + b":["
+                    current = key
+                else:
+                    buffer += b","
+                buffer += dumps(self.transform(doc))
+                if len(buffer) >= FLUSH_SIZE:
+                    yield bytes(buffer)
+                    buffer.clear()
+        finally:
+            await self._close()
+        if current is not _missing:
+            buffer += b"]"
+        buffer += b"}"
+        yield bytes(buffer)
+
+
+class _EventStreamGZipResponder(GZipResponder):
+    async def send_with_gzip(self, message: Message) -> None:
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            # the responder passes bodies through untouched when it thinks they are already encoded
+            if Headers(raw=message["headers"]).get("content-type", "").startswith("text/event-stream"):
+                self.content_encoding_set = True
+
+
+class EventStreamGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that leaves text/event-stream responses alone.
+
+    starlette's gzip writes streamed bodies into the compressor without flushing, so server-sent events would sit in
+    its buffer instead of reaching the client as they happen.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _EventStreamGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
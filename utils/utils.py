@@ -11,6 +11,8 @@ from datetime import datetime, timedelta
 import io
 import asyncio
 import aiohttp
+import contextlib
+import orjson
 from fastapi import HTTPException
 from base64 import b64decode as base64_b64decode
 from json import loads as json_loads
@@ -69,6 +71,7 @@ class DBClient():
         self.legend_rankings: collection_class = self.new_looper.legend_rankings
         self.war_logs_db: collection_class = self.looper.war_logs
         self.player_stats_db: collection_class = self.new_looper.player_stats
+        self.legend_seasons: collection_class = self.new_looper.legend_seasons
         self.attack_db: collection_class = self.looper.warhits
         self.war_timer: collection_class = self.looper.war_timer
         self.join_leave_history: collection_class = self.looper.join_leave_history
@@ -81,14 +84,18 @@ class DBClient():
 
         self.clan_cache_db: collection_class = self.new_looper.clan_cache
         self.clan_wars: collection_class = self.looper.clan_war
+        self.player_wars: collection_class = self.looper.player_wars
         self.legend_history: collection_class = self.looper.legend_history
         self.base_stats: collection_class = self.looper.base_stats
         self.capital: collection_class = self.looper.raid_weekends
         self.clan_stats: collection_class = self.new_looper.clan_stats
         self.rankings: collection_class = self.new_looper.rankings
         self.cwl_groups: collection_class = self.looper.cwl_group
+        self.cwl_standings: collection_class = self.new_looper.cwl_standings
 
         self.clan_history: collection_class = self.new_looper.clan_history
+        self.clan_activity: collection_class = self.new_looper.clan_activity
+        self.change_stream_state: collection_class = self.new_looper.change_stream_state
         self.ranking_history: collection_class = client.ranking_history
         self.player_trophies: collection_class = self.ranking_history.player_trophies
         self.player_versus_trophies: collection_class = self.ranking_history.player_versus_trophies
@@ -105,6 +112,41 @@ class DBClient():
 db_client = DBClient()
 
 
+_proxy_session = None
+_proxy_session_loop = None
+
+
+async def get_proxy_session():
+    global _proxy_session, _proxy_session_loop
+
+    loop = asyncio.get_running_loop()
+    if _proxy_session is None or _proxy_session.closed or _proxy_session_loop is not loop:
+        timeout = aiohttp.ClientTimeout(total=30)
+        connector = aiohttp.TCPConnector(limit=50, ttl_dns_cache=300)
+        _proxy_session = aiohttp.ClientSession(timeout=timeout, connector=connector)
+        _proxy_session_loop = loop
+    return _proxy_session
+
+
+async def fetch_proxy_json(path: str, semaphore: asyncio.Semaphore = None):
+    """GET a coc api path through the proxy on the shared session, None on any non 200"""
+    session = await get_proxy_session()
+    url = f"https://proxy.clashk.ing/v1/{path.replace('#', '%23')}"
+    if semaphore is None:
+        semaphore = contextlib.nullcontext()
+    async with semaphore:
+        async with session.get(url) as response:
+            if response.status != 200:
+                await response.read()
+                return None
+            return await response.json(loads=orjson.loads, content_type=None)
+
+
+async def close_proxy_session():
+    if _proxy_session is not None and not _proxy_session.closed:
+        await _proxy_session.close()
+
+
 async def download_image(url: str):
     async with aiohttp.ClientSession() as session:
         async with session.get(url) as response:
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+
+from collections import defaultdict
+from utils.utils import fetch_proxy_json
+from utils.war_log import war_summary
+
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 10
+POLL_CONCURRENCY = 25
+# events a subscriber may have waiting before it is considered gone and disconnected
+MAX_PENDING = 256
+# the last event a subscriber gets, after it the stream ends
+CLOSED = ("close", {})
+
+
+def war_attacks(war: dict) -> list[dict]:
+    attacks = []
+    for side in ("clan", "opponent"):
+        for member in war.get(side, {}).get("members", []):
+            for attack in member.get("attacks", []):
+                attacks.append({"attackerClan": side, "attackerTag": attack.get("attackerTag"), "defenderTag": attack.get("defenderTag"),
+                                "stars": attack.get("stars"), "destructionPercentage": attack.get("destructionPercentage"),
+                                "order": attack.get("order", 0), "duration": attack.get("duration", 0)})
+    attacks.sort(key=lambda a: a["order"])
+    return attacks
+
+
+class WarFeed:
+    """
+    Live war events for every clan someone is subscribed to, from one shared poller.
+
+    Each subscriber gets a queue, the poller fetches currentwar once per clan per interval no matter how many
+    subscribers that clan has, diffs it against the last poll and only publishes what changed: a "war" event when a
+    war starts or changes state and an "attack" event per attack with a higher order than seen before.
+    The poller runs while there are subscribers and stops by itself when the last one leaves. A subscriber that
+    falls MAX_PENDING events behind is dropped and sent CLOSED, as is everyone when the feed stops.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        self._wars: dict[str, dict] = {}
+        self._task: asyncio.Task | None = None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for queue in {queue for queues in self._subscribers.values() for queue in queues}:
+            self._close(queue)
+
+    def subscribe(self, clan_tags: list[str]) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=MAX_PENDING)
+        for clan_tag in clan_tags:
+            self._subscribers[clan_tag].add(queue)
+            # a clan that is already polled has a known war, the new subscriber starts from it
+            if clan_tag in self._wars:
+                queue.put_nowait(("war", {"clan_tag": clan_tag, "war": self._wars[clan_tag]["summary"]}))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, clan_tags: list[str]):
+        for clan_tag in clan_tags:
+            subscribers = self._subscribers.get(clan_tag)
+            if subscribers is None:
+                continue
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[clan_tag]
+                self._wars.pop(clan_tag, None)
+
+    def _close(self, queue: asyncio.Queue):
+        """Drops a subscriber, whatever it hadn't read yet is replaced by CLOSED"""
+        for clan_tag in [clan_tag for clan_tag, queues in self._subscribers.items() if queue in queues]:
+            self.unsubscribe(queue, [clan_tag])
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(CLOSED)
+
+    def _publish(self, clan_tag: str, event: tuple[str, dict]):
+        for queue in list(self._subscribers.get(clan_tag, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning(f"dropping a live war subscriber of {clan_tag}, it is {MAX_PENDING} events behind")
+                self._close(queue)
+
+    async def _poll(self):
+        semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+        while self._subscribers:
+            try:
+                await self._poll_once(semaphore)
+            except Exception:
+                logger.exception("live war poll failed")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _poll_once(self, semaphore: asyncio.Semaphore):
+        clan_tags = list(self._subscribers)
+        wars = await asyncio.gather(*[fetch_proxy_json(f"clans/{clan_tag}/currentwar", semaphore=semaphore) for clan_tag in clan_tags],
+                                    return_exceptions=True)
+        for clan_tag, war in zip(clan_tags, wars):
+            if isinstance(war, Exception):
+                logger.warning(f"could not poll the current war of {clan_tag}: {war!r}")
+                continue
+            # private war logs and proxy hiccups return nothing, the last known war stays as is
+            if not war or clan_tag not in self._subscribers:
+                continue
+            # one odd war must not take the poller, and with it every other clan's feed, down
+            try:
+                events = self._diff(clan_tag=clan_tag, war=war)
+            except Exception:
+                logger.exception(f"could not diff the current war of {clan_tag}")
+                continue
+            for event in events:
+                self._publish(clan_tag, event)
+
+    def _diff(self, clan_tag: str, war: dict) -> list[tuple[str, dict]]:
+        previous = self._wars.get(clan_tag)
+        summary = war_summary(war)
+        attacks = war_attacks(war)
+        new_war = previous is None or previous["id"] != war.get("preparationStartTime")
+
+        events = []
+        if new_war or previous["state"] != war.get("state"):
+            events.append(("war", {"clan_tag": clan_tag, "war": summary}))
+        # the first poll of a clan only sets the baseline, subscribers already got the war with its totals
+        if previous is not None:
+            since = 0 if new_war else previous["order"]
+            totals = {"clan": summary["clan"], "opponent": summary["opponent"]}
+            events.extend(("attack", {"clan_tag": clan_tag, "attack": attack} | totals) for attack in attacks if attack["order"] > since)
+
+        self._wars[clan_tag] = {"id": war.get("preparationStartTime"), "state": war.get("state"), "summary": summary,
+                                "order": max((a["order"] for a in attacks), default=0)}
+        return events
+
+
+war_feed = WarFeed()
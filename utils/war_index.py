@@ -0,0 +1,210 @@
+"""
+Player -> war inverted index backing /player/{tag}/warhits.
+
+Every ended war in clan_wars is expanded into one document per participant holding the war summary, the
+member snapshot and their attack & defense rows, so a player's war history is a sorted, limited index scan.
+Wars still in preparation or in war change on every poll, so they aren't indexed, the route merges them in from
+clan_wars through a (members.tag, state) index per side, and players without any index entries are served straight from clan_wars the way warhits always was.
+
+    python -m utils.war_index backfill [--since YYYYMMDDTHHMMSS.000Z]
+    python -m utils.war_index watch
+"""
+import argparse
+import asyncio
+import coc
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne
+from utils import change_streams
+from utils.utils import db_client
+
+
+logger = logging.getLogger(__name__)
+
+WATCHER = "war_index"
+LIVE_STATES = ["preparation", "inWar"]
+
+coc_client = coc.Client(raw_attribute=True)
+
+
+def war_unique_id(war: coc.ClanWar) -> str:
+    return "-".join(sorted([war.clan_tag, war.opponent.tag])) + f"-{int(war.preparation_start_time.time.timestamp())}"
+
+
+def _member_snapshot(member: coc.ClanWarMember) -> dict:
+    raw = dict(member._raw_data)
+    raw.pop("bestOpponentAttack", None)
+    raw.pop("attacks", None)
+    return raw
+
+
+def _war_summary(war: coc.ClanWar, war_data: dict) -> dict:
+    war_summary = {k: v for k, v in war_data.items() if k not in {"status_code", "_response_retry", "timestamp"}}
+    war_summary["clan"] = {k: v for k, v in war_data["clan"].items() if k != "members"}
+    war_summary["opponent"] = {k: v for k, v in war_data["opponent"].items() if k != "members"}
+    war_summary["type"] = war.type
+    return war_summary
+
+
+def _member_entry(member: coc.ClanWarMember, war_id: str, war_summary: dict, war_data: dict) -> dict:
+    attacks = []
+    for attack in member.attacks:
+        raw_attack = dict(attack._raw_data)
+        raw_attack["fresh"] = attack.is_fresh_attack
+        raw_attack["defender"] = _member_snapshot(attack.defender)
+        raw_attack["attack_order"] = attack.order
+        attacks.append(raw_attack)
+
+    defenses = []
+    for defense in member.defenses:
+        raw_defense = dict(defense._raw_data)
+        raw_defense["fresh"] = defense.is_fresh_attack
+        raw_defense["attacker"] = _member_snapshot(defense.attacker)
+        raw_defense["attack_order"] = defense.order
+        defenses.append(raw_defense)
+
+    return {
+        "tag": member.tag,
+        "war_id": war_id,
+        "preparationStartTime": war_data.get("preparationStartTime"),
+        "war_data": war_summary,
+        "member_data": _member_snapshot(member),
+        "attacks": attacks,
+        "defenses": defenses
+    }
+
+
+def build_entries(war_data: dict) -> list[dict]:
+    """Expand a raw war into one warhits entry per member on either side"""
+    war = coc.ClanWar(data=war_data, client=coc_client)
+    war_summary = _war_summary(war, war_data)
+    war_id = war_unique_id(war)
+    return [_member_entry(member, war_id, war_summary, war_data) for member in war.members]
+
+
+def player_entry(war_data: dict, player_tag: str) -> dict | None:
+    """The warhits entry of a single player, None if they aren't in the war"""
+    war = coc.ClanWar(data=war_data, client=coc_client)
+    member = war.get_member(player_tag)
+    if member is None:
+        return None
+    return _member_entry(member, war_unique_id(war), _war_summary(war, war_data), war_data)
+
+
+def _player_wars_query(player_tag: str, start: str, end: str) -> dict:
+    return {"$and": [{"$or": [{"data.clan.members.tag": player_tag}, {"data.opponent.members.tag": player_tag}]},
+                     {"data.preparationStartTime": {"$gte": start}}, {"data.preparationStartTime": {"$lte": end}}]}
+
+
+async def entries_from_wars(player_tag: str, start: str, end: str, limit: int, live_only: bool = False) -> list[dict]:
+    """Warhits entries built straight from clan_wars, for wars that are (or can't yet be) in the index"""
+    query = _player_wars_query(player_tag, start, end)
+    if live_only:
+        # each $or branch is a bounded scan of the (members.tag, state) index of its side
+        query["$and"].append({"data.state": {"$in": LIVE_STATES}})
+    wars = db_client.clan_wars.aggregate([
+        {"$match": query},
+        {"$project": {"_id": 0, "data": 1}},
+        {"$sort": {"data.preparationStartTime": -1}}
+    ], allowDiskUse=True)
+    entries = {}
+    try:
+        async for war in wars:
+            entry = player_entry(war["data"], player_tag)
+            if entry is None or entry["war_id"] in entries:
+                continue
+            entries[entry["war_id"]] = entry
+            if len(entries) == limit:
+                break
+    finally:
+        await wars.close()
+    return list(entries.values())
+
+
+async def get_warhits(player_tag: str, start: str, end: str, limit: int) -> list[dict]:
+    indexed = await db_client.player_wars.find(
+        {"tag": player_tag, "preparationStartTime": {"$gte": start, "$lte": end}},
+        {"_id": 0, "war_id": 1, "preparationStartTime": 1, "war_data": 1, "member_data": 1, "attacks": 1, "defenses": 1}
+    ).sort("preparationStartTime", -1).limit(limit).to_list(length=None)
+    if not indexed and await db_client.player_wars.find_one({"tag": player_tag}, {"_id": 1}) is None:
+        # not indexed (yet), the old full scan is slow but complete
+        entries = await entries_from_wars(player_tag=player_tag, start=start, end=end, limit=limit)
+    else:
+        live = await entries_from_wars(player_tag=player_tag, start=start, end=end, limit=limit, live_only=True)
+        seen = {entry["war_id"] for entry in indexed}
+        entries = indexed + [entry for entry in live if entry["war_id"] not in seen]
+        entries.sort(key=lambda entry: entry["preparationStartTime"], reverse=True)
+    return [{"war_data": e["war_data"], "member_data": e["member_data"], "attacks": e["attacks"], "defenses": e["defenses"]}
+            for e in entries[:limit]]
+
+
+async def index_war(war_data: dict):
+    if war_data.get("state") != "warEnded":
+        return
+    entries = build_entries(war_data)
+    if entries:
+        await db_client.player_wars.bulk_write(
+            [ReplaceOne({"tag": e["tag"], "war_id": e["war_id"]}, e, upsert=True) for e in entries], ordered=False)
+
+
+async def ensure_indexes():
+    await db_client.player_wars.create_indexes([
+        IndexModel([("tag", ASCENDING), ("war_id", ASCENDING)], unique=True),
+        IndexModel([("tag", ASCENDING), ("preparationStartTime", DESCENDING)]),
+    ])
+    await db_client.clan_wars.create_indexes([
+        IndexModel([("data.clan.members.tag", ASCENDING), ("data.state", ASCENDING)]),
+        IndexModel([("data.opponent.members.tag", ASCENDING), ("data.state", ASCENDING)]),
+    ])
+
+
+async def backfill(since: str = None):
+    await ensure_indexes()
+    query = {"data.state": "warEnded"}
+    if since:
+        query["data.preparationStartTime"] = {"$gte": since}
+    count = 0
+    async for war in db_client.clan_wars.find(query, {"data": 1}).batch_size(500):
+        try:
+            await index_war(war["data"])
+        except Exception:
+            logger.exception(f"could not index war {war.get('_id')}")
+        count += 1
+        if count % 10_000 == 0:
+            logger.info(f"indexed {count} wars")
+    logger.info(f"backfill done, indexed {count} wars")
+
+
+async def watch():
+    await ensure_indexes()
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}, "fullDocument.data.state": "warEnded"}}
+    ]
+    # re-indexing a war replaces its entries, so replaying a few changes after a restart is harmless
+    checkpoint = change_streams.Checkpoint(WATCHER)
+    while True:
+        state = await change_streams.load_state(WATCHER)
+        try:
+            async with db_client.clan_wars.watch(pipeline, full_document="updateLookup", **change_streams.resume_options(state)) as stream:
+                async for change in stream:
+                    await index_war(change["fullDocument"]["data"])
+                    await checkpoint(change["_id"])
+        except Exception as e:
+            if change_streams.history_lost(e):
+                logger.error("resume token is older than the oplog, wars that ended meanwhile need a backfill --since")
+                await change_streams.reset_token(WATCHER)
+            else:
+                logger.exception("clan war change stream failed, restarting")
+            await asyncio.sleep(5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the player -> war index")
+    parser.add_argument("command", choices=["backfill", "watch"])
+    parser.add_argument("--since", default=None, help="only backfill wars prepared after this coc timestamp")
+    args = parser.parse_args()
+    if args.command == "backfill":
+        asyncio.run(backfill(since=args.since))
+    else:
+        asyncio.run(watch())
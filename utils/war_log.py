@@ -0,0 +1,101 @@
+"""
+Server side war log queries on clan_wars.
+
+A clan's wars never overlap, so ordering them by preparationStartTime is the same as ordering them by endTime, and a
+(side tag, preparationStartTime) index per side lets Mongo merge both sides of the $or in order. A war can be stored
+any number of times (once per tracked side, plus custom copies), so copies are folded on preparationStartTime before
+the limit, carrying only the _id, and just the wars on the page are loaded in full. The indexes end in _id, so the fold
+is covered and no war document is fetched until the $lookup.
+
+    python -m utils.war_log    (creates the indexes)
+"""
+import asyncio
+
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from utils.utils import db_client
+
+
+# the war without its member rosters, shared by the war log view, the live feed and the cwl standings
+SUMMARY_KEYS = ("state", "teamSize", "attacksPerMember", "preparationStartTime", "startTime", "endTime")
+SIDE_KEYS = ("tag", "name", "badgeUrls", "clanLevel", "attacks", "stars", "destructionPercentage", "expEarned")
+
+
+def previous_wars_pipeline(clan_tag: str, start: str, end: str, limit: int, projection: dict = None) -> list[dict]:
+    return [
+        {"$match": {"$and": [
+            {"$or": [{"data.clan.tag": clan_tag}, {"data.opponent.tag": clan_tag}]},
+            {"data.preparationStartTime": {"$gte": start}},
+            {"data.preparationStartTime": {"$lte": end}}
+        ]}},
+        {"$sort": {"data.preparationStartTime": -1}},
+        {"$group": {"_id": "$data.preparationStartTime", "war": {"$first": "$_id"}}},
+        {"$sort": {"_id": -1}},
+        {"$limit": limit},
+        {"$lookup": {"from": db_client.clan_wars.name, "localField": "war", "foreignField": "_id", "as": "war"}},
+        {"$unwind": "$war"},
+        {"$replaceRoot": {"newRoot": "$war"}},
+        {"$project": projection or {"_id": 0, "data": 1}},
+        {"$replaceRoot": {"newRoot": "$data"}}
+    ]
+
+
+async def war_by_end_time(clan_tag: str, end_time: datetime, projection: dict = None) -> dict | None:
+    """The war of `clan_tag` that ended within 5 minutes of `end_time`, as stored (under data)"""
+    lower_end_time = end_time - timedelta(minutes=5)
+    higher_end_time = end_time + timedelta(minutes=5)
+    return await db_client.clan_wars.find_one({"$and" : [{"$or" : [{"data.clan.tag" : clan_tag}, {"data.opponent.tag" : clan_tag}]},
+                                                         {"data.endTime" : {"$gte" : lower_end_time.strftime('%Y%m%dT%H%M%S.000Z')}},
+                                                         {"data.endTime" : {"$lte" : higher_end_time.strftime('%Y%m%dT%H%M%S.000Z')}}]},
+                                              projection or {"_id": 0, "data": 1})
+
+
+def war_summary(war: dict) -> dict:
+    """summary_expression for a war that is already in memory, sides as stored"""
+    summary = {key: war.get(key) for key in SUMMARY_KEYS}
+    summary["clan"] = {key: war.get("clan", {}).get(key) for key in SIDE_KEYS}
+    summary["opponent"] = {key: war.get("opponent", {}).get(key) for key in SIDE_KEYS}
+    return summary
+
+
+def _side(var: str) -> dict:
+    return {key: f"{var}.{key}" for key in SIDE_KEYS}
+
+
+def summary_expression(clan_tag: str, root: str = "$data") -> dict:
+    """
+    War log view of a war, everything but the member rosters, seen from `clan_tag`'s side.
+
+    An aggregation expression so it can be used in a find projection or a $project stage and the members never
+    leave the database.
+    """
+    ours = {"$cond": [{"$eq": [f"{root}.opponent.tag", clan_tag]}, f"{root}.opponent", f"{root}.clan"]}
+    theirs = {"$cond": [{"$eq": [f"{root}.opponent.tag", clan_tag]}, f"{root}.clan", f"{root}.opponent"]}
+    return {"$let": {
+        "vars": {"us": ours, "them": theirs},
+        "in": {key: f"{root}.{key}" for key in SUMMARY_KEYS} | {
+            "clan": _side("$$us"),
+            "opponent": _side("$$them"),
+            "result": {"$switch": {
+                "branches": [
+                    {"case": {"$ne": [f"{root}.state", "warEnded"]}, "then": None},
+                    {"case": {"$gt": ["$$us.stars", "$$them.stars"]}, "then": "win"},
+                    {"case": {"$lt": ["$$us.stars", "$$them.stars"]}, "then": "lose"},
+                    {"case": {"$gt": ["$$us.destructionPercentage", "$$them.destructionPercentage"]}, "then": "win"},
+                    {"case": {"$lt": ["$$us.destructionPercentage", "$$them.destructionPercentage"]}, "then": "lose"},
+                ],
+                "default": "tie"
+            }}
+        }
+    }}
+
+
+async def ensure_indexes():
+    await db_client.clan_wars.create_indexes([
+        IndexModel([("data.clan.tag", ASCENDING), ("data.preparationStartTime", DESCENDING), ("_id", ASCENDING)]),
+        IndexModel([("data.opponent.tag", ASCENDING), ("data.preparationStartTime", DESCENDING), ("_id", ASCENDING)]),
+    ])
+
+
+if __name__ == "__main__":
+    asyncio.run(ensure_indexes())